@@ -3,33 +3,262 @@ import binascii
 import os
 import time
 import toml
-import glob
+import logging
 import struct
 import sys
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Callable
+from typing import Dict
 from typing import List
 from typing import NoReturn
 from typing import Optional
+from urllib.parse import urlparse
 
 import cflib
 from cflib.bootloader import Bootloader, Cloader, Target
 from cflib.crazyflie import Crazyflie
+from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+from cflib.crazyflie.toc import CMD_TOC_ELEMENT, CMD_TOC_ITEM_V2, TOC_CHANNEL
 from cflib.crtp.crtpstack import CRTPPacket
 from cflib.crtp.crtpstack import CRTPPort
 from cflib.utils.power_switch import PowerSwitch
 
+import sim
+
+from requirements_index import Requirement
+from requirements_index import RequirementIndex
+
 DIR = os.path.dirname(os.path.realpath(__file__))
 SITE_PATH = os.path.join(DIR, 'sites/')
-REQUIREMENT = os.path.join(DIR, 'requirements/')
+TOC_CACHE = os.path.abspath(os.getenv('CRAZY_TOC_CACHE', os.path.join(DIR, 'cache')))
+
+logger = logging.getLogger(__name__)
+
+_drivers_initialized = False
+
+
+def init_drivers():
+    ''' Initialize the cflib link drivers, once per process '''
+    global _drivers_initialized
+    if not _drivers_initialized:
+        cflib.crtp.init_drivers()
+        sim.init_drivers()
+        _drivers_initialized = True
+
+
+class TocCacheStats:
+    '''
+    Hits and misses of the TOC cache in this process. The bytes saved are
+    the CRTP payload bytes the TOC download would have taken.
+    '''
+    # Per element: the request (cmd, id) and the reply (cmd, id, type,
+    # group and name with their terminating zeros)
+    ITEM_BYTES = 3 + 6
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def count(self, toc: dict, downloaded: bool):
+        ''' Count a TOC ({group: {name: element}}), downloaded or found in the cache '''
+        if downloaded:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.bytes_saved += sum(self.ITEM_BYTES + len(group) + len(name)
+                                    for group in toc for name in toc[group])
+
+    def add(self, stats: dict):
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        self.bytes_saved += stats['bytes_saved']
+
+    def as_dict(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'bytes_saved': self.bytes_saved}
+
+    def __str__(self):
+        return '{} hits, {} misses, {} bytes saved'.format(self.hits, self.misses, self.bytes_saved)
+
+
+# TOCs of BCDevice.connect_sync() found in the TOC cache (CRAZY_TOC_CACHE),
+# shared by all devices, runs and pytest-xdist workers. Entries are keyed by
+# the TOC CRC reported by the firmware, so devices running the same firmware
+# (and decks) only download the TOCs once.
+toc_cache_stats = TocCacheStats()
+
+
+class BootResult:
+    '''
+    The outcome of BCDevice.reboot(wait=True). It is truthy if the device
+    came back up, and holds the seconds from powering up the STM32:
+
+      firmware   until the firmware answers an echo packet
+      connected  until connect_sync() succeeded, log and param TOCs included
+    '''
+
+    def __init__(self):
+        self.firmware = None
+        self.connected = None
+        self.connect = None  # The ConnectResult of the connection
+        self.error = None
+
+    def __bool__(self):
+        return self.connected is not None
+
+    def __str__(self):
+        if self:
+            return 'booted: firmware up in {:.0f} ms, connected in {:.0f} ms'.format(
+                self.firmware * 1000, self.connected * 1000)
+        return 'boot failed: {}'.format(self.error)
+
+
+class ConnectResult:
+    '''
+    The outcome of BCDevice.connect_sync(). It is truthy if the connection
+    succeeded, and holds the duration (seconds) of each connection phase:
+
+      link          open_link() until the first packet from the Crazyflie
+      log_toc       log TOC downloaded (or found in the cache)
+      param_toc     memories and param TOC downloaded (or found in the cache)
+      param_values  values of all parameters fetched (only if waited for)
+    '''
+    PHASES = ('link', 'log_toc', 'param_toc', 'param_values')
+
+    def __init__(self):
+        self.connected = False
+        self.error = None
+        self.timed_out = None  # The phase that did not finish in time
+        self.timings = dict()
+
+    def __bool__(self):
+        return self.connected
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+    def __str__(self):
+        phases = ', '.join('{}: {:.1f} ms'.format(phase, t * 1000)
+                           for phase, t in self.timings.items())
+        if self.connected:
+            return 'connected in {:.1f} ms ({})'.format(self.total * 1000, phases)
+        if self.timed_out:
+            return 'timed out in phase {} ({})'.format(self.timed_out, phases)
+        return 'connection failed: {}'.format(self.error)
+
+
+def _remove_callback(caller, cb):
+    try:
+        caller.remove_callback(cb)
+    except ValueError:
+        pass
+
+
+class CallbackWaiter:
+    '''
+    A callback for cflib that records the arguments of each call, so a test
+    can wait for the calls instead of sleeping. Every wait returns as soon as
+    the calls have been made, the timeout is only an upper bound. Assert on
+    the recorded arguments in the test, since an exception raised in a cflib
+    callback is lost.
+
+        stored = CallbackWaiter()
+        cf.param.persistent_store(param, stored)
+        assert stored.result(timeout=5) == (param, True)
+
+    Only calls for which the optional accept(*args) is true are recorded,
+    with the host time (time.perf_counter()) of each call in times.
+    '''
+
+    def __init__(self, accept: Optional[Callable[..., bool]] = None):
+        self.calls = list()
+        self.times = list()
+        self._accept = accept
+        self._cond = threading.Condition()
+
+    def __call__(self, *args):
+        if self._accept is not None and not self._accept(*args):
+            return
+        now = time.perf_counter()
+        with self._cond:
+            self.calls.append(args)
+            self.times.append(now)
+            self._cond.notify_all()
+
+    @property
+    def count(self) -> int:
+        return len(self.calls)
+
+    def wait(self, count=1, timeout=5) -> bool:
+        ''' Wait for count calls, return false if they are not made within timeout seconds '''
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.calls) >= count, timeout)
+
+    def result(self, timeout=5) -> tuple:
+        ''' The arguments of the first call, raises TimeoutError if it is not made within timeout seconds '''
+        if not self.wait(1, timeout):
+            raise TimeoutError('no callback within {} s'.format(timeout))
+        return self.calls[0]
+
+
+class HealthReport:
+    ''' The outcome of BCDevice.probe() '''
+
+    def __init__(self, dev: 'BCDevice'):
+        self.device = dev
+        self.rtts = []  # seconds, for each answered echo
+        self.firmware = False
+        self.bootloader = None  # Only probed if the firmware does not answer
+        self.link_quality = None
+        self.rssi = None
+        self.recovered = False
+
+    @property
+    def rtt(self) -> Optional[float]:
+        ''' Median echo round trip time in seconds '''
+        if not self.rtts:
+            return None
+        return sorted(self.rtts)[len(self.rtts) // 2]
+
+    @property
+    def status(self) -> str:
+        if self.firmware:
+            return 'recovered' if self.recovered else 'ok'
+        if self.bootloader:
+            return 'bootloader'
+        return 'dead'
+
+    @staticmethod
+    def table(reports: List['HealthReport']) -> str:
+        def fmt(value, spec):
+            return '-' if value is None else spec.format(value)
+
+        rows = [('device', 'status', 'rtt ms', 'echoes', 'link %', 'rssi')]
+        for r in reports:
+            rows.append((r.device.name, r.status,
+                         fmt(r.rtt and r.rtt * 1000, '{:.2f}'),
+                         str(len(r.rtts)),
+                         fmt(r.link_quality, '{:.0f}'),
+                         fmt(r.rssi, '{:.0f}')))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(col.ljust(w) for col, w in zip(row, widths)).rstrip()
+                         for row in rows)
 
 
 class BCDevice:
+    '''
+    A device in the site. Constructing it is cheap, the Crazyflie and
+    Bootloader objects (and the link drivers) are created the first time
+    they are used.
+    '''
     CONNECT_TIMEOUT = 10  # seconds
 
     def __init__(self, name, device):
-        cflib.crtp.init_drivers()
-
         self.name = name
         self.link_uri = device['radio']
         try:
@@ -43,49 +272,204 @@ class BCDevice:
         if 'decks' in device:
             self.decks = device['decks']
 
-        self.cf = Crazyflie(rw_cache='./cache')
-        self.bl = Bootloader(self.link_uri)
+        if sim.is_sim_uri(self.link_uri):
+            sim.configure(self.link_uri, decks=self.decks)
+
+        self._cf = None
+        self._bl = None
+        self.uri_cache = None  # Forget link_uri here if connecting fails
+
+    @property
+    def cf(self) -> Crazyflie:
+        if self._cf is None:
+            init_drivers()
+            self._cf = Crazyflie(rw_cache=TOC_CACHE)
+        return self._cf
+
+    @property
+    def bl(self) -> Bootloader:
+        if self._bl is None:
+            init_drivers()
+            self._bl = Bootloader(self.link_uri)
+        return self._bl
 
     def __str__(self):
         return '{} @ {}'.format(self.name, self.link_uri)
 
+    def disconnect(self) -> bool:
+        '''
+        Close the link and wait for cflib to report it disconnected. Does
+        nothing if the Crazyflie object has not been used.
+        '''
+        if self._cf is None:
+            return True
+
+        disconnected = threading.Event()
+
+        def disconnected_cb(uri):
+            disconnected.set()
+
+        self._cf.disconnected.add_callback(disconnected_cb)
+        try:
+            self._cf.close_link()
+            return disconnected.wait(self.CONNECT_TIMEOUT)
+        finally:
+            _remove_callback(self._cf.disconnected, disconnected_cb)
+
+    def bl_uri(self, address: str) -> str:
+        ''' The bootloader URI of the device, given its bootloader address '''
+        return '{}/0/2M/{}?safelink=0'.format(self.radio, address)
+
+    @property
+    def radio(self) -> str:
+        ''' The radio dongle used to reach the device, i.e. radio://0 '''
+        uri = urlparse(self.link_uri)
+        return '{}://{}'.format(uri.scheme, uri.netloc)
+
+    @property
+    def kalman_active(self) -> bool:
+        ''' True if the decks of the device make the firmware run the kalman estimator '''
+        kalman_decks = ['bcLighthouse4', 'bcFlow', 'bcFlow2', 'bcDWM1000']
+        if self.decks:
+            return all(deck in kalman_decks for deck in self.decks)
+        else:
+            return False
+
     def firmware_up(self) -> bool:
         ''' Return true if we can contact the (stm32 based) firmware '''
-        timeout = 2  # seconds
-        link = cflib.crtp.get_link_driver(self.link_uri)
+        return self.probe(echoes=1).firmware
 
-        pk = CRTPPacket()
-        pk.set_header(CRTPPort.LINKCTRL, 0)  # Echo channel
-        pk.data = b'test'
-        link.send_packet(pk)
+    def probe(self, echoes=5, timeout=2) -> HealthReport:
+        '''
+        Send LINKCTRL echo packets to the firmware, one at a time, and
+        measure their round trip times. If the firmware does not answer
+        within timeout seconds, check if the device is in bootloader mode.
+        '''
+        report = HealthReport(self)
+        stats = dict()
+        init_drivers()
+        link = cflib.crtp.get_link_driver(self.link_uri, stats.update)
+        if link is None:
+            return report
+
+        try:
+            deadline = time.time() + timeout
+            for i in range(echoes):
+                pk = CRTPPacket()
+                pk.set_header(CRTPPort.LINKCTRL, 0)  # Echo channel
+                pk.data = struct.pack('<I', i)
 
-        ts = time.time()
-        while True:
-            if time.time() - ts > timeout:
-                break
+                start = time.perf_counter()
+                if not self._request(link, pk, deadline):
+                    break
+                report.rtts.append(time.perf_counter() - start)
+        finally:
+            link.close()
 
-            pk_ack = link.receive_packet(0.1)
-            if pk_ack is None:
-                continue
+        report.firmware = len(report.rtts) > 0
+        report.link_quality = stats.get('link_quality')
+        report.rssi = stats.get('uplink_rssi')
 
-            if pk_ack.port != CRTPPort.LINKCTRL or pk_ack.channel != 0:
-                continue
+        if not report.firmware and self.uri_cache is not None:
+            self.uri_cache.invalidate(self.link_uri)
 
-            if pk.data == pk_ack.data:
-                link.close()
-                return True
+        if not report.firmware and self.bl_link_uri is not None:
+            report.bootloader = self.bootloader_up(timeout)
+
+        return report
+
+    def bootloader_up(self, timeout=2) -> bool:
+        ''' Return true if the nRF bootloader answers on bl_link_uri '''
+        init_drivers()
+        link = cflib.crtp.get_link_driver(self.bl_link_uri)
+        if link is None:
+            return False
 
-        link.close()
+        # 0xFF => BOOTLOADER CMD, 0xFE => NRF target, 0x10 => GET_INFO
+        pk = CRTPPacket(0xFF, [0xFE, 0x10])
+        try:
+            return self._request(link, pk, time.time() + timeout, prefix=2)
+        finally:
+            link.close()
+
+    @staticmethod
+    def _request(link, pk: CRTPPacket, deadline: float, prefix: Optional[int] = None,
+                 resend: float = 0.5) -> bool:
+        '''
+        Send pk and wait for the answer: same header and data, or with
+        prefix set, the same first prefix bytes of data. The packet is sent
+        again every resend seconds, in case the device was still booting.
+        '''
+        expected = bytes(pk.data[:prefix])
+        sent = 0
+        while time.time() < deadline:
+            if time.time() - sent > resend:
+                link.send_packet(pk)
+                sent = time.time()
+
+            answer = link.receive_packet(0.1)
+            if answer is None or answer.get_header() != pk.get_header():
+                continue
+            if bytes(answer.data[:prefix]) == expected:
+                return True
         return False
 
-    def reboot(self):
+    def reboot(self, wait=False, timeout=10, interval=0.05) -> Optional[BootResult]:
+        '''
+        Power cycle the STM32. With wait set, block until the firmware
+        answers echo packets, sent every interval seconds, and then until
+        connect_sync() succeeds, and return the BootResult. The device is
+        disconnected when it returns.
+        '''
+        init_drivers()
         switch = PowerSwitch(self.link_uri)
-        switch.stm_power_cycle()
+        try:
+            if not wait:
+                switch.stm_power_cycle()
+                return None
+
+            # As stm_power_cycle(), but time the boot from power up
+            switch.stm_power_down()
+            time.sleep(1)
+            switch.stm_power_up()
+            start = time.perf_counter()
+        finally:
+            switch.close()
+
+        result = BootResult()
+        deadline = time.time() + timeout
+        link = cflib.crtp.get_link_driver(self.link_uri)
+        if link is None:
+            result.error = 'no link driver for {}'.format(self.link_uri)
+            return result
+
+        pk = CRTPPacket()
+        pk.set_header(CRTPPort.LINKCTRL, 0)  # Echo channel
+        pk.data = struct.pack('<I', 0)
+        try:
+            up = self._request(link, pk, deadline, resend=interval)
+        finally:
+            link.close()
+        if not up:
+            result.error = 'firmware not up within {} s'.format(timeout)
+            return result
+        result.firmware = time.perf_counter() - start
+
+        result.connect = self.connect_sync()
+        self.disconnect()
+        if not result.connect:
+            result.error = str(result.connect)
+            return result
+        result.connected = time.perf_counter() - start
+
+        logger.info('{}: {}'.format(self.name, result))
+        return result
 
     def recover(self):
         if self.bl_link_uri is None:
             return False
 
+        init_drivers()
         cloader = Cloader(None)
         cloader.link = cflib.crtp.get_link_driver(self.bl_link_uri)
         if cloader.link is None:
@@ -109,48 +493,342 @@ class BCDevice:
         finally:
             self.bl.close()
 
-    def connect_sync(self, querystring=None):
-        self.cf.close_link()
+    def connect_sync(self, querystring=None, wait_for_params=False, cf: Optional[Crazyflie] = None) -> ConnectResult:
+        '''
+        Connect and block until the log and param TOCs are available, or
+        also until all param values are fetched if wait_for_params is set.
+        Waits on the cflib connection callbacks, the returned ConnectResult
+        is truthy on success and holds the timing of each phase.
+
+        Another Crazyflie object than the one of the device can be given as
+        cf, for instance one without a TOC cache. Closing its link is then up
+        to the caller.
+        '''
+        self.disconnect()
 
         if querystring is None:
             uri = self.link_uri
         else:
             uri = self.link_uri + querystring
 
-        self.cf.open_link(uri)
+        own = cf is None
+        if own:
+            cf = self.cf
+        result = ConnectResult()
+        done = threading.Event()
+        marks = [time.perf_counter()]
+        downloaded = set()  # Ports of the TOCs not found in the cache
+
+        def mark(phase: str):
+            # Phases end in order, only record the one in progress
+            if len(marks) == ConnectResult.PHASES.index(phase) + 1:
+                marks.append(time.perf_counter())
+                result.timings[phase] = marks[-1] - marks[-2]
+
+        def link_established_cb(uri):
+            mark('link')
+
+        def packet_received_cb(pk):
+            if pk.channel == TOC_CHANNEL and pk.data and pk.data[0] in (CMD_TOC_ELEMENT, CMD_TOC_ITEM_V2):
+                downloaded.add(pk.port)
+
+        def packet_sent_cb(pk):
+            # Memories are queried right after the log TOC is done
+            if pk.port == CRTPPort.MEM:
+                mark('log_toc')
+
+        def connected_cb(uri):
+            mark('param_toc')
+            if own:
+                toc_cache_stats.count(cf.log.toc.toc, CRTPPort.LOGGING in downloaded)
+                toc_cache_stats.count(cf.param.toc.toc, CRTPPort.PARAM in downloaded)
+            if not wait_for_params:
+                result.connected = True
+                done.set()
 
-        ts = time.time()
-        while not self.cf.is_connected():
-            time.sleep(1.0 / 1000.0)
-            delta = time.time() - ts
-            if delta > self.CONNECT_TIMEOUT:
-                return False
-        return True
+        def fully_connected_cb(uri):
+            mark('param_values')
+            result.connected = True
+            done.set()
+
+        def failed_cb(uri, msg):
+            result.error = msg
+            done.set()
+
+        callbacks = [
+            (cf.link_established, link_established_cb),
+            (cf.packet_received, packet_received_cb),
+            (cf.packet_sent, packet_sent_cb),
+            (cf.connected, connected_cb),
+            (cf.fully_connected, fully_connected_cb),
+            (cf.connection_failed, failed_cb),
+            (cf.connection_lost, failed_cb),
+        ]
+        for caller, cb in callbacks:
+            caller.add_callback(cb)
+
+        try:
+            cf.open_link(uri)
+            if not done.wait(self.CONNECT_TIMEOUT):
+                result.timed_out = ConnectResult.PHASES[len(marks) - 1]
+        finally:
+            for caller, cb in callbacks:
+                _remove_callback(caller, cb)
+
+        if not result and self.uri_cache is not None:
+            self.uri_cache.invalidate(self.link_uri)
+
+        logger.info('{}: {}'.format(self.name, result))
+        return result
+
+
+class ConnectionPool:
+    '''
+    Keeps a connected SyncCrazyflie per device between tests, so that link
+    setup and TOC download are done once instead of in every test. Only one
+    pooled link per radio is kept open, devices sharing a radio take turns.
+    '''
+
+    def __init__(self):
+        self._links = dict()  # radio -> (BCDevice, SyncCrazyflie)
+
+    def _pooled(self, dev: BCDevice) -> Optional[SyncCrazyflie]:
+        pooled, scf = self._links.get(dev.radio, (None, None))
+        if pooled is dev and scf.is_link_open():
+            return scf
+        return None
+
+    def acquire(self, dev: BCDevice) -> SyncCrazyflie:
+        ''' Return the pooled link to dev, connect it if needed '''
+        scf = self._pooled(dev)
+        if scf is None:
+            self.close(dev.radio)
+            dev.disconnect()
+            scf = SyncCrazyflie(dev.link_uri, cf=dev.cf)
+            scf.open_link()
+            # Hand out a quiet link, not one still fetching param values
+            scf.wait_for_params()
+            self._links[dev.radio] = (dev, scf)
+        return scf
+
+    def release(self, dev: BCDevice):
+        '''
+        Hand back the link after a test. Log blocks and callbacks added by
+        the test are removed. A link not opened by the pool (connect_sync(),
+        fresh connections) is closed.
+        '''
+        if self._pooled(dev) is None:
+            dev.disconnect()
+            return
+
+        cf = dev.cf
+        if cf.log.log_blocks:
+            cf.log.reset()
+        cf.param.param_update_callbacks.clear()
+        cf.param.group_update_callbacks.clear()
+        cf.param.all_update_callback.callbacks.clear()
+        cf.console.receivedChar.callbacks.clear()
+
+    def close(self, radio: Optional[str] = None):
+        ''' Close the pooled links, on one radio or all of them '''
+        radios = list(self._links) if radio is None else [radio]
+        for r in radios:
+            if r in self._links:
+                dev, scf = self._links.pop(r)
+                scf.close_link()
+                dev.disconnect()
 
 
 class DeviceFixture:
-    def __init__(self, dev: BCDevice):
+    def __init__(self, dev: BCDevice, pool: ConnectionPool):
         self._device = dev
+        self._pool = pool
 
     @property
     def device(self) -> BCDevice:
         return self._device
 
+    @contextmanager
+    def connection(self, fresh=False):
+        '''
+        Borrow the pooled SyncCrazyflie of the device for the duration of a
+        with block. Tests that reboot the device or need a cold connection
+        should pass fresh=True, it opens a new link that is closed after.
+        '''
+        if not fresh:
+            yield self._pool.acquire(self._device)
+            return
+
+        self._pool.close(self._device.radio)
+        with SyncCrazyflie(self._device.link_uri, cf=self._device.cf) as scf:
+            yield scf
+
     @property
     def kalman_active(self) -> bool:
-        kalman_decks = ['bcLighthouse4', 'bcFlow', 'bcFlow2', 'bcDWM1000']
-        if self._device.decks:
-            return all(deck in kalman_decks for deck in self._device.decks)
-        else:
-            return False
+        return self._device.kalman_active
+
+
+def get_item_devices(item) -> List[BCDevice]:
+    '''
+    Return the devices a test item is parametrized with, either as a device
+    or as a list of devices sharing a radio
+    '''
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None:
+        return []
+
+    devices = list()
+    for value in callspec.params.values():
+        if isinstance(value, BCDevice):
+            devices.append(value)
+        elif isinstance(value, (list, tuple)):
+            devices.extend(v for v in value if isinstance(v, BCDevice))
+    return devices
+
+
+def get_item_device(item) -> Optional[BCDevice]:
+    ''' Return the (first) device a test item is parametrized with, if any '''
+    devices = get_item_devices(item)
+    return devices[0] if devices else None
+
+
+def get_devices_by_radio() -> Dict[str, List[BCDevice]]:
+    ''' The devices of the site grouped by radio, i.e. radio://0 '''
+    radios = dict()
+    for dev in get_devices():
+        radios.setdefault(dev.radio, []).append(dev)
+    return radios
+
+
+def pytest_addoption(parser):
+    parser.addoption('--health-check', action='store_true', default=False,
+                     help='Probe all devices in the site before the session, start devices stuck in '
+                          'bootloader mode and deselect the tests of devices that do not answer')
+    parser.addoption('--record-log', metavar='DIR', default=None,
+                     help='Record the raw log packets of test_log_stress to DIR, per device, for replay with '
+                          'log_replay.py')
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_sessionstart(session):
+    '''
+    Run the health check once, in the controller when using pytest-xdist,
+    before any tests are collected.
+    '''
+    config = session.config
+    config.unhealthy_devices = set()
+    if hasattr(config, 'workerinput'):
+        config.unhealthy_devices = set(config.workerinput['unhealthy_devices'])
+        return
+    if not config.getoption('health_check') or os.getenv('CRAZY_SITE') is None:
+        return
+
+    reports = check_health(get_devices(), recover=True)
+    reporter = config.pluginmanager.get_plugin('terminalreporter')
+    reporter.write_sep('-', 'device health')
+    reporter.write_line(HealthReport.table(reports))
+    config.unhealthy_devices = {r.device.name for r in reports if not r.firmware}
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    ''' Workers must deselect the same tests, so they get the controller's health check '''
+    node.workerinput['unhealthy_devices'] = sorted(getattr(node.config, 'unhealthy_devices', set()))
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):
+    ''' With -n auto, start one worker per radio in the site '''
+    if os.getenv('CRAZY_SITE') is None:
+        return None
+    return len({dev.radio for dev in get_devices()})
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    '''
+    Group tests by the radio of their device. Devices sharing a radio must be
+    tested one at a time, but devices on different radios can be tested in
+    parallel by running pytest-xdist with --dist loadgroup.
+    '''
+    unhealthy = getattr(config, 'unhealthy_devices', set())
+    if unhealthy:
+        selected, deselected = [], []
+        for item in items:
+            names = {dev.name for dev in get_item_devices(item)}
+            (deselected if names & unhealthy else selected).append(item)
+        if deselected:
+            items[:] = selected
+            config.hook.pytest_deselected(items=deselected)
+
+    for item in items:
+        dev = get_item_device(item)
+        if dev is not None:
+            item.add_marker(pytest.mark.xdist_group(name=dev.radio))
+
+    # Run all tests of one device before moving to the next, so the pooled
+    # connection is not closed and reopened when devices share a radio.
+    order = dict()
+
+    def device_order(item):
+        dev = get_item_device(item)
+        if dev is None:
+            return -1
+        return order.setdefault(dev.name, len(order))
+
+    items.sort(key=device_order)
+
+
+def pytest_sessionfinish(session):
+    ''' Hand the TOC cache stats of a pytest-xdist worker to the controller '''
+    workeroutput = getattr(session.config, 'workeroutput', None)
+    if workeroutput is not None:
+        workeroutput['toc_cache'] = toc_cache_stats.as_dict()
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    stats = getattr(node, 'workeroutput', {}).get('toc_cache')
+    if stats is not None:
+        toc_cache_stats.add(stats)
+
+
+def pytest_terminal_summary(terminalreporter):
+    stats = toc_cache_stats
+    if stats.hits or stats.misses:
+        terminalreporter.write_line('TOC cache {}: {}'.format(TOC_CACHE, stats))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def link_drivers():
+    ''' Initialize the link drivers before the first test, not at collection '''
+    init_drivers()
+
+
+@pytest.fixture(scope='session')
+def connection_pool():
+    ''' Connections shared by the tests, closed at the end of the session '''
+    pool = ConnectionPool()
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def raw_link(dev, connection_pool):
+    '''
+    For tests that open their own links to dev. The pooled link on its radio
+    is closed first, or it would keep polling on the same dongle and take
+    the answers meant for the test.
+    '''
+    connection_pool.close(dev.radio)
 
 
 @pytest.fixture
-def test_setup(request):
+def test_setup(request, connection_pool):
     ''' This code will run before (and after) a test '''
-    fix = DeviceFixture(request.param)
+    fix = DeviceFixture(request.param, connection_pool)
     yield fix  # code after this point will run as teardown after test
-    fix.device.cf.close_link()
+    connection_pool.release(fix.device)
 
 
 def get_bl_address(dev: BCDevice) -> str:
@@ -159,6 +837,7 @@ def get_bl_address(dev: BCDevice) -> str:
     and receive the bootloader radio address in the response
     '''
     address = None
+    init_drivers()
     link = cflib.crtp.get_link_driver(dev.link_uri)
     if link is None:
         return None
@@ -189,107 +868,223 @@ def get_bl_address(dev: BCDevice) -> str:
     return address
 
 
-def get_devices() -> List[BCDevice]:
-    devices = list()
+RECOVER_TIMEOUT = 5  # seconds for a recovered device to boot
+
+
+def check_health(devices: List[BCDevice], recover=False) -> List[HealthReport]:
+    '''
+    Probe all devices at the same time, so a sweep takes about as long as
+    probing one device. With recover set, devices found in bootloader mode
+    are started and probed again.
+    '''
+    if not devices:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        reports = list(executor.map(lambda dev: dev.probe(), devices))
+
+        stuck = [r for r in reports if r.bootloader] if recover else []
+        recovered = list(executor.map(lambda r: r.device.recover(), stuck))
+        again = list(executor.map(lambda r: r.device.probe(timeout=RECOVER_TIMEOUT), stuck))
+
+    for old, ok, new in zip(stuck, recovered, again):
+        new.recovered = ok and new.firmware
+        reports[reports.index(old)] = new
+
+    return reports
 
+
+def bootloader_cache_path(site: str) -> str:
+    ''' Bootloader URIs found by management/bootloader_addresses.py are kept here '''
+    return os.path.join(SITE_PATH, '%s.bootloaders.toml' % site)
+
+
+def load_bootloader_cache(site: str) -> dict:
+    ''' Return the cached bootloader URI of each device name in the site '''
+    path = bootloader_cache_path(site)
+    if not os.path.exists(path):
+        return dict()
+
+    try:
+        cache = toml.load(path)
+    except Exception as err:
+        logger.warning('Failed to read bootloader cache {}: {}'.format(path, err))
+        return dict()
+
+    return {name: device['bootloader_radio'] for name, device in cache.get('device', {}).items()}
+
+
+def save_bootloader_cache(site: str, uris: dict):
+    ''' Add or update the bootloader URIs (device name -> URI) in the cache '''
+    cache = load_bootloader_cache(site)
+    cache.update(uris)
+
+    path = bootloader_cache_path(site)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('# Generated by management/bootloader_addresses.py, bootloader_radio in\n')
+        f.write('# %s.toml takes precedence over the URIs here.\n' % site)
+        toml.dump({'device': {name: {'bootloader_radio': uri} for name, uri in sorted(cache.items())}}, f)
+    os.replace(tmp, path)
+
+
+_site_devices = {}
+
+
+def get_devices() -> List[BCDevice]:
+    '''
+    Return the devices of the site in CRAZY_SITE. The site is parsed once per
+    process and the same BCDevice objects are returned on every call.
+    '''
     site = os.getenv('CRAZY_SITE')
     if site is None:
         raise Exception('No CRAZY_SITE env specified!')
 
-    path = ""
-    try:
-        path = os.path.join(SITE_PATH, '%s.toml' % site)
-        site_t = toml.load(open(path, 'r'))
+    if site not in _site_devices:
+        devices = list()
+
+        path = ""
+        try:
+            path = os.path.join(SITE_PATH, '%s.toml' % site)
+            site_t = toml.load(open(path, 'r'))
+            bootloaders = load_bootloader_cache(site)
 
-        for name, device in site_t['device'].items():
-            devices.append(BCDevice(name, device))
-    except Exception:
-        raise Exception('Failed to parse toml %s!' % path)
+            for name, device in site_t['device'].items():
+                if 'bootloader_radio' not in device and name in bootloaders:
+                    device['bootloader_radio'] = bootloaders[name]
+                devices.append(BCDevice(name, device))
+        except Exception:
+            raise Exception('Failed to parse toml %s!' % path)
 
-    return devices
+        _site_devices[site] = devices
+
+    return list(_site_devices[site])
+
+
+class SwarmUriCache:
+    '''
+    URIs of swarm devices found by scanning, saved between runs next to the
+    swarm YAML. An entry is dropped when connecting to it fails, so it is
+    scanned for again on the next run.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._uris = dict()
+        if os.path.exists(path):
+            try:
+                self._uris = toml.load(path)
+            except Exception as err:
+                logger.warning('Failed to read swarm URI cache {}: {}'.format(path, err))
+
+    def get(self, address: str) -> Optional[str]:
+        return self._uris.get(address)
+
+    def update(self, uris: dict):
+        self._uris.update(uris)
+        self._save()
+
+    def invalidate(self, uri: str):
+        stale = [address for address, cached in self._uris.items() if cached == uri]
+        for address in stale:
+            del self._uris[address]
+        if stale:
+            self._save()
+
+    def _save(self):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            toml.dump(self._uris, f)
+        os.replace(tmp, self.path)
+
+
+def scan_addresses(addresses: List[str]) -> dict:
+    '''
+    Find the channel and datarate of radio addresses in one pass, keeping the
+    Crazyradio open and setting each datarate once, instead of one full
+    scan_interfaces() per address. Returns a dict of address -> URI.
+    '''
+    from cflib.crtp.radiodriver import RadioManager
+    from cflib.drivers.crazyradio import Crazyradio
+
+    found = dict()
+    radio = RadioManager.open(0)
+    try:
+        radio.set_arc(1)
+        for datarate, name in ((Crazyradio.DR_2MPS, '2M'),
+                               (Crazyradio.DR_1MPS, '1M'),
+                               (Crazyradio.DR_250KPS, '250K')):
+            radio.set_data_rate(datarate)
+            for address in addresses:
+                if address in found:
+                    continue
+                radio.set_address(tuple(binascii.unhexlify(address)))
+                channels = list(radio.scan_channels(0, 125, (0xff,)))
+                if channels:
+                    found[address] = 'radio://0/{}/{}/{}'.format(channels[0], name, address)
+    finally:
+        radio.close()
+
+    return found
 
 
 def get_swarm() -> List[BCDevice]:
     '''
-    Given a path to the Crazyswarm project source and path in the
-    CRAZYSWARM_PATH environment variable and a path to a YAML file defining
-    a swarm in CRAZYSWARM_YAML return a list of BCDevice.
+    Return a list of BCDevice for the swarm defined in the YAML file named by
+    the CRAZYSWARM_YAML environment variable, found in swarms/. Devices with
+    a channel in the YAML are reached at 2M, like Crazyswarm does. The
+    others are found with a single scan, and the result is cached.
     '''
+    import yaml
+
     devices = list()
+    init_drivers()
 
     try:
-        crazyswarm_path = os.environ['CRAZYSWARM_PATH']
-        sys.path.append(os.path.join(
-            crazyswarm_path,
-            'ros_ws/src/crazyswarm/scripts'
-        ))
-        sys.path.append(os.path.join(
-            crazyswarm_path,
-            'ros_ws/src/crazyflie_ros'
-        ))
-        from pycrazyswarm import Crazyswarm
-
         crazyflies_yaml = os.path.join(
             os.path.dirname(os.path.realpath(__file__)),
             'swarms',
             os.environ['CRAZYSWARM_YAML']
         )
-        cs = Crazyswarm(crazyflies_yaml=crazyflies_yaml)
-
-        for cf in cs.allcfs.crazyflies:
-            address = 'E7E7E7E7{:X}'.format(cf.id)
-
-            # get URI from address using scan
-            found = cflib.crtp.scan_interfaces(int(address, 16))
-            if not found:
-                raise Exception(f'No device found @ {address}!')
-
-            dev = BCDevice(
-                name=f'swarm-{cf.id}',
-                device={
-                    'radio': found[0][0],
-                    'bootloader_radio': None,
-                }
-            )
-            devices.append(dev)
     except KeyError as err:
-        print('CRAZYSWARM_PATH or CRAZYSWARM_YAML not set', file=sys.stderr)
-        raise err
-    except ImportError as err:
-        print('Failed to import pycrazyswarm', file=sys.stderr)
+        print('CRAZYSWARM_YAML not set', file=sys.stderr)
         raise err
 
-    return devices
+    with open(crazyflies_yaml, 'r') as f:
+        crazyflies = yaml.safe_load(f)['crazyflies']
 
+    cache = SwarmUriCache(os.path.splitext(crazyflies_yaml)[0] + '.uris.toml')
+    addresses = ['E7E7E7E7{:X}'.format(cf['id']) for cf in crazyflies]
+    uris = dict()
+    for cf, address in zip(crazyflies, addresses):
+        if 'channel' in cf:
+            uris[address] = 'radio://0/{}/2M/{}'.format(cf['channel'], address)
+        elif cache.get(address) is not None:
+            uris[address] = cache.get(address)
 
-class Requirements(dict):
-    _instance = None
+    missing = [address for address in addresses if address not in uris]
+    if missing:
+        found = scan_addresses(missing)
+        cache.update(found)
+        uris.update(found)
 
-    def __init__(self):
-        raise RuntimeError('Call instance() instead')
-
-    @classmethod
-    def _read_requirements(cls):
-        requirements = glob.glob(REQUIREMENT + '*.toml')
-        for requirement in requirements:
-            req = toml.load(open(requirement))
-            for key, value in req.items():
-                if type(value) == dict:
-                    if key not in cls._instance:
-                        cls._instance[key] = {}
-                    for subkey, subvalue in value.items():
-                        cls._instance[key][subkey] = subvalue
-                else:
-                    cls._instance[key] = value
-
-    @classmethod
-    def instance(cls):
-        if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-            cls._read_requirements()
-        return cls._instance
-
-
-def get_requirement(requirement: str):
-    group, name = requirement.split('.')
-    return Requirements.instance()['requirement'][group][name]
+    for cf, address in zip(crazyflies, addresses):
+        if address not in uris:
+            raise Exception(f'No device found @ {address}!')
+
+        dev = BCDevice(
+            name=f'swarm-{cf["id"]}',
+            device={
+                'radio': uris[address],
+                'bootloader_radio': None,
+            }
+        )
+        dev.uri_cache = cache
+        devices.append(dev)
+
+    return devices
+
+
+def get_requirement(requirement: str) -> Requirement:
+    ''' Return a requirement by its id, like "radio.bwsmall" '''
+    return RequirementIndex.instance()[requirement]
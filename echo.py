@@ -0,0 +1,282 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Echo latency and bandwidth measurements over a raw link to a Crazyflie, on
+the LINKCTRL echo channel. Used by the radio tests and
+management/radio_matrix.py.
+'''
+import logging
+import threading
+import time
+
+from collections import Counter
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+import cflib.crtp
+from cflib.crtp.crtpstack import CRTPPort
+
+import traffic
+
+from latency import LatencyResult
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the other links when starting them together
+BARRIER_TIMEOUT = 10
+
+
+def latency(uri, packet_size=4, count=500, timeout=2, pattern='sequence') -> LatencyResult:
+    '''
+    Send count echo packets, one at a time, and measure their round trip
+    times. An echo not answered within timeout seconds is counted as a
+    timeout, and a late answer to it is ignored. The payload is generated
+    from pattern, see traffic.TrafficGenerator.
+    '''
+    generator = traffic.TrafficGenerator(packet_size, pattern)
+    link = cflib.crtp.get_link_driver(uri)
+    samples = np.full(count, np.nan)
+
+    try:
+        for i in range(count):
+            pk = generator.packet(i)
+
+            start_time = time.perf_counter_ns()
+            if not link.send_packet(pk):
+                raise Exception("send_packet() timeout!")
+
+            deadline = start_time + timeout * 1_000_000_000
+            while True:
+                wait = (deadline - time.perf_counter_ns()) / 1e9
+                pk_ack = link.receive_packet(wait) if wait > 0 else None
+                if pk_ack is None:
+                    break
+                if pk_ack.port != CRTPPort.LINKCTRL or pk_ack.channel != 0:
+                    continue
+
+                # make sure we actually received the expected value
+                i_recv = traffic.sequence(pk_ack.data)
+                if i_recv < i:
+                    continue  # Late answer to a timed out echo
+                assert(i == i_recv)
+                samples[i] = (time.perf_counter_ns() - start_time) / 1e6
+                break
+    finally:
+        link.close()
+
+    result = LatencyResult(samples)
+    logger.info('latency: {}'.format(result))
+
+    return result
+
+
+class SequenceChecker:
+    '''
+    Accounts for sequence numbers (0, 1, 2, ...) of received packets in
+    constant memory. Packets up to window behind the highest one seen are
+    tracked: a missing one arriving late counts as reordered, one arriving
+    twice as a duplicate. Packets still missing when they fall out of the
+    window are lost, and packets arriving even later are out of window.
+    Call finish() with the number of packets sent when done.
+    '''
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._seen = bytearray(window)  # Ring buffer, by sequence % window
+        self.highest = -1
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.out_of_window = 0
+        self.bursts = Counter()  # burst length -> count
+        self._burst = 0
+        self._finalized = 0  # Sequence numbers below this are accounted for
+
+    def _finalize(self, until: int):
+        ''' Account for all sequence numbers below until as received or lost '''
+        # Only sequence numbers up to the highest one seen can have arrived
+        tracked = min(until, self.highest + 1)
+        for seq in range(self._finalized, tracked):
+            slot = seq % self.window
+            if self._seen[slot]:
+                self._end_burst()
+                self._seen[slot] = 0
+            else:
+                self._lose(1)
+
+        untracked = until - max(self._finalized, tracked)
+        if untracked > 0:
+            self._lose(untracked)
+        self._finalized = max(self._finalized, until)
+
+    def _lose(self, count: int):
+        self.lost += count
+        self._burst += count
+
+    def _end_burst(self):
+        if self._burst:
+            self.bursts[self._burst] += 1
+            self._burst = 0
+
+    def add(self, seq: int):
+        if seq > self.highest:
+            self._finalize(seq - self.window + 1)
+            self.highest = seq
+        elif seq < self._finalized:
+            self.out_of_window += 1
+            return
+        elif self._seen[seq % self.window]:
+            self.duplicates += 1
+            return
+        else:
+            self.reordered += 1
+
+        self._seen[seq % self.window] = 1
+        self.received += 1
+
+    def finish(self, sent: int):
+        ''' Account for the rest of the sent packets, as received or lost '''
+        self._finalize(sent)
+        self._end_burst()
+
+    @property
+    def loss_ratio(self) -> float:
+        total = self.received + self.lost
+        return self.lost / total if total else 0.0
+
+    def __str__(self):
+        bursts = ', '.join('{}: {}'.format(length, count) for length, count in sorted(self.bursts.items()))
+        return ('{} received, {} lost ({:.4%}), {} duplicates, {} reordered, {} out of window, '
+                'loss bursts (length: count) {{{}}}').format(
+                    self.received, self.lost, self.loss_ratio, self.duplicates, self.reordered,
+                    self.out_of_window, bursts)
+
+
+class BandwidthResult:
+    '''
+    Echo throughput measured by bandwidth(). The rate is for the whole run,
+    samples holds the rate of each sample period (the last one is partial).
+    '''
+
+    def __init__(self, count: int, window: int, duration: float, samples: np.ndarray):
+        self.count = count
+        self.window = window
+        self.duration = duration
+        self.rate = count / duration
+        self.samples = samples
+
+    def __str__(self):
+        samples = ', '.join('{:.0f}'.format(s) for s in self.samples)
+        return '{:.0f} packets/s over {:.2f} s, per period: [{}]'.format(self.rate, self.duration, samples)
+
+
+def bandwidth(uri, packet_size=4, count=500, window=None, sample_period=1.0,
+              checker: Optional[SequenceChecker] = None, pattern='sequence', rate=None,
+              barrier: Optional[threading.Barrier] = None) -> BandwidthResult:
+    '''
+    Echo count packets and measure the throughput. A sender thread keeps at
+    most window packets in flight (all of them if None), and sends at most
+    rate packets/s if given, while the answers are received. Without a
+    checker, any lost or reordered answer fails the measurement. With one,
+    the answers are accounted for in the checker and the measurement ends
+    when the last packet is answered or nothing has been received for a
+    while. Measurements of several links sharing a barrier start together.
+    '''
+    window = count if window is None else window
+    generator = traffic.TrafficGenerator(packet_size, pattern)
+    link = cflib.crtp.get_link_driver(uri)
+
+    in_flight = threading.BoundedSemaphore(window)
+    stop = threading.Event()
+    errors = []
+    periods = [0]  # answers received in each sample period
+
+    def sender():
+        try:
+            for i, pk in generator.stream(count, rate):
+                while not in_flight.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if not link.send_packet(pk):
+                    raise Exception("send_packet() timeout!")
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=sender, name='bandwidth-sender', daemon=True)
+    received = 0
+    try:
+        if barrier is not None:
+            barrier.wait(BARRIER_TIMEOUT)
+        start_time = time.perf_counter_ns()
+        end_time = start_time
+        thread.start()
+
+        # get the result
+        i = 0
+        while i < count:
+            pk_ack = link.receive_packet(2)
+            if errors:
+                raise errors[0]
+            if pk_ack is None:
+                if checker is not None:
+                    break
+                raise Exception("Receive packet timeout!")
+            if pk_ack.port != CRTPPort.LINKCTRL or pk_ack.channel != 0:
+                continue
+
+            end_time = time.perf_counter_ns()
+            period = int((end_time - start_time) / 1e9 / sample_period)
+            periods.extend([0] * (period + 1 - len(periods)))
+            periods[period] += 1
+            received += 1
+
+            # make sure we actually received the expected value
+            i_recv = traffic.sequence(pk_ack.data)
+            if checker is None:
+                assert(i_recv == i)
+            else:
+                checker.add(i_recv)
+
+            # Packets lost before the answered one are no longer in flight
+            for _ in range(i, i_recv + 1):
+                in_flight.release()
+            i = max(i, i_recv + 1)
+    finally:
+        stop.set()
+        thread.join()
+        link.close()
+
+    if checker is not None:
+        checker.finish(count)
+
+    duration = (end_time - start_time) / 1e9
+    if duration <= 0:
+        raise Exception("No packets received!")
+
+    lengths = np.full(len(periods), sample_period)
+    lengths[-1] = duration - sample_period * (len(periods) - 1)
+    samples = np.array(periods) / np.where(lengths > 0, lengths, sample_period)
+
+    result = BandwidthResult(received, window, duration, samples)
+    logger.info('bandwidth: {}'.format(result))
+
+    return result
+
+
+def bandwidth_sweep(uri, packet_size=4, windows=(1, 2, 4, 8, 16, 32), count=500) -> List[BandwidthResult]:
+    ''' Measure the throughput for each in flight window size '''
+    return [bandwidth(uri, packet_size, count, window) for window in windows]
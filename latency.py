@@ -0,0 +1,45 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Statistics of round trip times, shared by the radio and parameter benchmarks.
+'''
+import numpy as np
+
+
+class LatencyResult:
+    '''
+    Round trip times (ms) of requests sent one at a time, such as radio echo
+    packets or parameter writes, with nan for the requests that timed out.
+    Jitter is the mean absolute difference between consecutive round trip
+    times, not the smoothed running estimate of RFC 3550.
+    '''
+
+    def __init__(self, samples: np.ndarray):
+        self.samples = samples[~np.isnan(samples)]
+        self.count = len(samples)
+        self.timeouts = self.count - len(self.samples)
+
+        if len(self.samples) == 0:
+            self.min = self.p50 = self.p90 = self.p99 = self.max = self.jitter = float('nan')
+            return
+
+        self.min = float(np.min(self.samples))
+        self.p50, self.p90, self.p99 = (float(p) for p in np.percentile(self.samples, [50, 90, 99]))
+        self.max = float(np.max(self.samples))
+        self.jitter = float(np.mean(np.abs(np.diff(self.samples)))) if len(self.samples) > 1 else 0.0
+
+    def __str__(self):
+        return ('min {:.2f} ms, p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms, '
+                'jitter {:.2f} ms, {} of {} timed out').format(
+                    self.min, self.p50, self.p90, self.p99, self.max, self.jitter, self.timeouts, self.count)
@@ -0,0 +1,218 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Capture of log data for long runs. A LogCapture is attached to
+LogConfig.data_received_cb and writes every row into a folder with one
+memory-mapped column file per variable, plus the firmware timestamp (ts) and
+the host receive time (host_ns). The files grow in steps, so the memory used
+does not depend on how long the capture runs.
+
+    capture = LogCapture('/tmp/stabilizer', config)
+    config.data_received_cb.add_callback(capture)
+    ...
+    capture.close()
+
+    columns = LogCaptureReader('/tmp/stabilizer')
+    columns['stabilizer.roll']  # numpy array
+
+Run it as a script to print a summary of a capture.
+'''
+import json
+import os
+import threading
+import time
+
+from typing import List
+from typing import Tuple
+
+import numpy as np
+
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.log import LogTocElement
+
+META = 'capture.json'
+VERSION = 1
+
+# Rows to grow the column files with when they are full
+GROW_ROWS = 1 << 16
+
+# numpy types of the log variable types, see LogTocElement.types
+DTYPES = {
+    'uint8_t': 'u1',
+    'uint16_t': '<u2',
+    'uint32_t': '<u4',
+    'int8_t': 'i1',
+    'int16_t': '<i2',
+    'int32_t': '<i4',
+    'FP16': '<f2',
+    'float': '<f4',
+}
+
+# Columns of every capture, before the variables
+TS_COLUMNS = [('ts', '<u4'), ('host_ns', '<i8')]
+
+
+def capture_columns(config: LogConfig) -> List[Tuple[str, str]]:
+    ''' The (name, numpy type) of each column when capturing config '''
+    return TS_COLUMNS + [(var.name, DTYPES[LogTocElement.get_cstring_from_id(var.fetch_as)])
+                         for var in config.variables]
+
+
+def _column_file(name: str) -> str:
+    return '{}.bin'.format(name)
+
+
+class LogCapture:
+    '''
+    Writes the rows of a LogConfig to column files in path, which must not
+    exist. Call close(), or use it as a context manager, to trim the files to
+    the rows captured. Rows flushed with flush() survive a crash.
+    '''
+
+    def __init__(self, path: str, config: LogConfig, grow_rows: int = GROW_ROWS):
+        os.makedirs(path)
+        self.path = path
+        self.name = config.name
+        self.period_ms = config.period_in_ms
+        self.columns = capture_columns(config)
+        self.rows = 0
+        self._grow_rows = grow_rows
+        self._capacity = 0
+        self._maps = dict()  # Column name -> np.memmap
+        self._variables = [name for name, _ in self.columns[len(TS_COLUMNS):]]
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._grow()
+        self._write_meta()
+
+    def _grow(self):
+        self._maps.clear()  # Unmaps and flushes the previous mappings
+        self._capacity += self._grow_rows
+        for name, dtype in self.columns:
+            filename = os.path.join(self.path, _column_file(name))
+            with open(filename, 'ab') as f:
+                f.truncate(self._capacity * np.dtype(dtype).itemsize)
+            self._maps[name] = np.memmap(filename, dtype=dtype, mode='r+', shape=(self._capacity,))
+
+    def _write_meta(self):
+        meta = {
+            'version': VERSION,
+            'name': self.name,
+            'period_ms': self.period_ms,
+            'rows': self.rows,
+            'columns': [{'name': name, 'dtype': dtype, 'file': _column_file(name)} for name, dtype in self.columns],
+        }
+        tmp = os.path.join(self.path, META + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, META))
+
+    def __call__(self, ts, data, config):
+        ''' The LogConfig.data_received_cb callback '''
+        host_ns = time.perf_counter_ns()
+        with self._lock:
+            if self._closed:
+                return
+            if self.rows == self._capacity:
+                self._grow()
+                self._write_meta()
+
+            row = self.rows
+            self._maps['ts'][row] = ts
+            self._maps['host_ns'][row] = host_ns
+            for name in self._variables:
+                self._maps[name][row] = data[name]
+            self.rows += 1
+
+    def flush(self):
+        with self._lock:
+            for column in self._maps.values():
+                column.flush()
+            self._write_meta()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._maps.clear()
+            for name, dtype in self.columns:
+                with open(os.path.join(self.path, _column_file(name)), 'r+b') as f:
+                    f.truncate(self.rows * np.dtype(dtype).itemsize)
+            self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LogCaptureReader:
+    '''
+    The columns of a capture as read-only, memory-mapped numpy arrays, by
+    name. Only the rows written when the capture was last flushed or closed
+    are included.
+    '''
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, META), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != VERSION:
+            raise ValueError('{}: unsupported capture version {}'.format(path, meta.get('version')))
+
+        self.path = path
+        self.name = meta['name']
+        self.period_ms = meta['period_ms']
+        self.rows = meta['rows']
+        self.columns = dict()  # Column name -> np.ndarray
+        for column in meta['columns']:
+            if self.rows == 0:
+                self.columns[column['name']] = np.zeros(0, dtype=column['dtype'])
+                continue
+            self.columns[column['name']] = np.memmap(os.path.join(path, column['file']), dtype=column['dtype'],
+                                                     mode='r', shape=(self.rows,))
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.columns)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    def __len__(self):
+        return self.rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print a summary of log captures')
+    parser.add_argument('paths', nargs='+', help='Capture folders')
+    p = parser.parse_args()
+
+    for path in p.paths:
+        capture = LogCaptureReader(path)
+        duration = (capture['host_ns'][-1] - capture['host_ns'][0]) / 1e9 if capture.rows > 1 else 0.0
+        print('{}: {} ({} ms period), {} rows over {:.1f} s'.format(
+            path, capture.name, capture.period_ms, capture.rows, duration))
+        for name in capture.names:
+            column = capture[name]
+            if len(column):
+                print('  {:24} {:8} min {:<14.6g} max {:<14.6g} mean {:.6g}'.format(
+                    name, str(column.dtype), column.min(), column.max(), column.mean(dtype=np.float64)))
@@ -0,0 +1,228 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Host-only benchmark of log decoding in cflib. A LogRecorder records the raw
+log data packets received by a Crazyflie, and saves them with the LogConfigs
+they belong to. The recording is replayed through the log port handler of
+cflib (Log._new_packet_cb), which finds the block, unpacks the variables and
+calls the data callbacks, as fast as possible and without any link.
+
+    recorder = LogRecorder(configs)
+    cf.add_port_callback(CRTPPort.LOGGING, recorder)
+    ...
+    recorder.save('stress.json')
+
+Run it as a script to replay recordings, and to measure the decoding cost
+of each variable type with generated packets.
+'''
+import base64
+import json
+import random
+import time
+
+from typing import List
+
+from cflib.crazyflie.log import CHAN_LOGDATA
+from cflib.crazyflie.log import Log
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.log import LogTocElement
+from cflib.crtp.crtpstack import CRTPPacket
+from cflib.crtp.crtpstack import CRTPPort
+
+VERSION = 1
+
+# The payload of a log data packet after the block id and timestamp
+MAX_LOG_DATA = 26
+
+
+class LogRecorder:
+    '''
+    Records the log data packets of configs, as a CRTPPort.LOGGING port
+    callback. The configs must have been added, so they have their ids, when
+    the recording is saved.
+    '''
+
+    def __init__(self, configs: List[LogConfig]):
+        self.configs = configs
+        self.count = 0
+        self._data = bytearray()  # Packet payloads, each prefixed with its length
+
+    def __call__(self, pk: CRTPPacket):
+        if pk.channel == CHAN_LOGDATA:
+            self._data.append(len(pk.data))
+            self._data += pk.data
+            self.count += 1
+
+    def save(self, path: str):
+        recording = {
+            'version': VERSION,
+            'configs': [{
+                'id': config.id,
+                'name': config.name,
+                'period_ms': config.period_in_ms,
+                'variables': [[var.name, LogTocElement.get_cstring_from_id(var.fetch_as)]
+                              for var in config.variables],
+            } for config in self.configs],
+            'count': self.count,
+            'packets': base64.b64encode(bytes(self._data)).decode('ascii'),
+        }
+        with open(path, 'w') as f:
+            json.dump(recording, f)
+
+
+class Recording:
+    ''' The LogConfigs, with their ids, and the raw log data packets of a recording '''
+
+    def __init__(self, configs: List[LogConfig], packets: List[bytes]):
+        self.configs = configs
+        self.packets = packets
+
+    @classmethod
+    def load(cls, path: str) -> 'Recording':
+        with open(path, 'r') as f:
+            recording = json.load(f)
+        if recording.get('version') != VERSION:
+            raise ValueError('{}: unsupported recording version {}'.format(path, recording.get('version')))
+
+        configs = list()
+        for c in recording['configs']:
+            config = LogConfig(name=c['name'], period_in_ms=c['period_ms'])
+            for name, ctype in c['variables']:
+                config.add_variable(name, ctype)
+            config.id = c['id']
+            configs.append(config)
+
+        data = base64.b64decode(recording['packets'])
+        packets = list()
+        i = 0
+        while i < len(data):
+            length = data[i]
+            packets.append(data[i + 1:i + 1 + length])
+            i += 1 + length
+
+        return cls(configs, packets)
+
+
+class _NoLink:
+    ''' Stands in for the Crazyflie of a Log, which only registers its port callback '''
+
+    def add_port_callback(self, port, cb):
+        pass
+
+
+class ReplayResult:
+    def __init__(self, packets: int, rows: int, variables: int, duration: float):
+        self.packets = packets
+        self.rows = rows
+        self.variables = variables
+        self.duration = duration
+        self.rate = rows / duration if duration > 0 else float('nan')
+        self.row_us = 1e6 * duration / rows if rows else float('nan')
+
+    def __str__(self):
+        return '{} rows in {:.3f} s: {:.0f} rows/s, {:.2f} us/row, {:.0f} variables/s'.format(
+            self.rows, self.duration, self.rate, self.row_us, self.variables / self.duration)
+
+
+def replay(recording: Recording, repeat: int = 1) -> ReplayResult:
+    ''' Decode the packets of recording repeat times, as fast as possible '''
+    log = Log(_NoLink())
+    log.log_blocks = list(recording.configs)
+
+    rows = 0
+    variables = 0
+
+    def count_cb(ts, data, config):
+        nonlocal rows, variables
+        rows += 1
+        variables += len(data)
+
+    for config in recording.configs:
+        config.data_received_cb.add_callback(count_cb)
+
+    # Built up front, so only the decoding is measured
+    packets = [CRTPPacket(CRTPPort.LOGGING << 4 | CHAN_LOGDATA, bytearray(data)) for data in recording.packets]
+
+    try:
+        start = time.perf_counter_ns()
+        for _ in range(repeat):
+            for pk in packets:
+                log._new_packet_cb(pk)
+        duration = (time.perf_counter_ns() - start) / 1e9
+    finally:
+        for config in recording.configs:
+            config.data_received_cb.remove_callback(count_cb)
+
+    return ReplayResult(len(packets) * repeat, rows, variables, duration)
+
+
+def generated(ctype=None, count: int = 10_000, seed: int = 0) -> Recording:
+    '''
+    A recording of count packets of one block, full of variables of ctype,
+    with random values. Without a ctype, the block has no variables and the
+    replay measures the cost of each packet alone.
+    '''
+    config = LogConfig(name='Generated', period_in_ms=10)
+    size = 0
+    if ctype is not None:
+        size = LogTocElement.get_size_from_id(LogTocElement.get_id_from_cstring(ctype))
+        for i in range(MAX_LOG_DATA // size):
+            config.add_variable('generated.v{}'.format(i), ctype)
+    config.id = 1
+
+    rng = random.Random(seed)
+    length = size * len(config.variables)
+    packets = [bytes([config.id]) + (i & 0xFFFFFF).to_bytes(3, 'little') +
+               bytes(rng.getrandbits(8) for _ in range(length)) for i in range(count)]
+    return Recording([config], packets)
+
+
+def type_costs(count: int = 10_000, repeat: int = 3):
+    '''
+    The decoding cost of each variable type, as (ctype, variables per packet,
+    us per row, us per variable). The cost per variable is on top of the cost
+    of a packet without variables, which is the first entry.
+    '''
+    def best(recording):
+        return min((replay(recording) for _ in range(repeat)), key=lambda r: r.row_us)
+
+    base = best(generated(None, count))
+    costs = [('(packet)', 0, base.row_us, float('nan'))]
+    for ctype, _, _ in sorted(LogTocElement.types.values(), key=lambda t: t[0]):
+        recording = generated(ctype, count)
+        variables = len(recording.configs[0].variables)
+        result = best(recording)
+        costs.append((ctype, variables, result.row_us, (result.row_us - base.row_us) / variables))
+    return costs
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay recorded log packets through the cflib log decoding, '
+                                                 'and measure the decoding cost of each variable type')
+    parser.add_argument('recordings', nargs='*', help='Recordings saved by a LogRecorder')
+    parser.add_argument('--repeat', type=int, default=10, help='Times to replay each recording')
+    parser.add_argument('--count', type=int, default=10_000, help='Packets per variable type')
+    p = parser.parse_args()
+
+    for path in p.recordings:
+        recording = Recording.load(path)
+        print('{}: {} packets, {} blocks'.format(path, len(recording.packets), len(recording.configs)))
+        print('  {}'.format(replay(recording, p.repeat)))
+
+    print('{:10} {:>9} {:>9} {:>13}'.format('type', 'variables', 'us/row', 'us/variable'))
+    for ctype, variables, row_us, variable_us in type_costs(p.count):
+        print('{:10} {:>9} {:>9.2f} {:>13}'.format(
+            ctype, variables, row_us, '-' if variables == 0 else '{:.3f}'.format(variable_us)))
@@ -0,0 +1,265 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Timing of log blocks, from the firmware timestamp and the host receive time
+of every row, and the search for the highest log packet rate a Crazyflie
+delivers without loss. Used by the log tests and management/log_rate.py.
+'''
+import logging
+import time
+
+from typing import List
+
+import numpy as np
+
+from cflib.crazyflie.log import LogConfig
+
+logger = logging.getLogger(__name__)
+
+# Log timestamps are 24 bit milliseconds
+TS_WRAP = 1 << 24
+
+
+class BlockTimingResult:
+    '''
+    Timing of the rows of one log block, from the firmware timestamp and the
+    host receive time of each row:
+
+        jitter_ms      standard deviation of the host inter-arrival times
+        max_gap_ms     longest step between consecutive firmware timestamps
+        missing        rows the firmware timestamps show were never received
+        drift_ppm      host clock rate relative to the firmware clock
+        latency_*_ms   host receive time minus firmware timestamp, corrected
+                       for drift, above the fastest row. The clocks are not
+                       synchronized, so this is latency on top of the best case.
+    '''
+
+    def __init__(self, name: str, period_ms: int, ts: np.ndarray, host_ns: np.ndarray, overflow: int):
+        self.name = name
+        self.period_ms = period_ms
+        self.rows = len(ts) + overflow
+        self.jitter_ms = self.max_gap_ms = self.drift_ppm = float('nan')
+        self.latency_p50_ms = self.latency_p99_ms = self.latency_max_ms = float('nan')
+        self.missing = 0
+        if len(ts) < 2:
+            return
+
+        steps = np.diff(ts) % TS_WRAP
+        fw_ms = np.concatenate(([0], np.cumsum(steps))).astype(float)
+        host_ms = (host_ns - host_ns[0]) / 1e6
+
+        self.jitter_ms = float(np.std(np.diff(host_ms)))
+        self.max_gap_ms = float(np.max(steps))
+        # From the whole span, a late row followed by an early one is not a loss
+        self.missing = max(int(round(fw_ms[-1] / period_ms)) + 1 - len(ts), 0)
+
+        slope = 1.0
+        if fw_ms[-1] > 0:
+            slope, _ = np.polyfit(fw_ms, host_ms, 1)
+        self.drift_ppm = float((slope - 1) * 1e6)
+
+        latency = host_ms - slope * fw_ms
+        latency -= np.min(latency)
+        self.latency_p50_ms, self.latency_p99_ms = (float(p) for p in np.percentile(latency, [50, 99]))
+        self.latency_max_ms = float(np.max(latency))
+
+    def __str__(self):
+        return ('{}: {} rows, jitter {:.2f} ms, max gap {:.0f} ms, {} missing, drift {:.0f} ppm, '
+                'latency p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms').format(
+                    self.name, self.rows, self.jitter_ms, self.max_gap_ms, self.missing, self.drift_ppm,
+                    self.latency_p50_ms, self.latency_p99_ms, self.latency_max_ms)
+
+
+class BlockTiming:
+    '''
+    Records the firmware timestamp and host receive time of every row of a
+    log block into arrays preallocated for duration seconds, with margin.
+    '''
+
+    def __init__(self, name: str, period_ms: int, duration: float):
+        capacity = int(duration * 1000 / period_ms * 1.5) + 100
+        self.name = name
+        self.period_ms = period_ms
+        self.ts = np.zeros(capacity, dtype=np.int64)
+        self.host_ns = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.overflow = 0
+
+    def record(self, ts: int):
+        host_ns = time.perf_counter_ns()
+        if self.count < len(self.ts):
+            self.ts[self.count] = ts
+            self.host_ns[self.count] = host_ns
+            self.count += 1
+        else:
+            self.overflow += 1
+
+    def result(self) -> BlockTimingResult:
+        return BlockTimingResult(self.name, self.period_ms, self.ts[:self.count], self.host_ns[:self.count],
+                                 self.overflow)
+
+
+def _proc_stat():
+    ''' The (busy, total) CPU time of the host, or None where /proc/stat is missing '''
+    try:
+        with open('/proc/stat', 'r') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)  # idle + iowait
+    return sum(fields) - idle, sum(fields)
+
+
+class HostLoad:
+    '''
+    CPU used on the host since created: process_cpu by this process, in
+    percent of one core, and host_cpu by the whole host, in percent of all
+    cores (None where /proc/stat is missing).
+    '''
+
+    def __init__(self):
+        self._start = (time.perf_counter(), time.process_time(), _proc_stat())
+        self.process_cpu = self.host_cpu = None
+
+    def stop(self) -> 'HostLoad':
+        wall, process, host = self._start
+        elapsed = time.perf_counter() - wall
+        self.process_cpu = 100.0 * (time.process_time() - process) / elapsed if elapsed > 0 else 0.0
+
+        end = _proc_stat()
+        if host is not None and end is not None and end[1] > host[1]:
+            self.host_cpu = 100.0 * (end[0] - host[0]) / (end[1] - host[1])
+        return self
+
+
+class LogRateResult:
+    '''
+    Log rows received with blocks MaxGroup blocks at period_ms, by
+    log_rate(). The rate is without loss if no block misses a firmware
+    timestamp and all blocks deliver the expected rows, within 3%.
+    '''
+
+    def __init__(self, blocks: int, period_ms: int, duration: float, results: List[BlockTimingResult],
+                 load: HostLoad):
+        self.blocks = blocks
+        self.period_ms = period_ms
+        self.rate = blocks * 1000.0 / period_ms
+        self.delivered = sum(r.rows for r in results) / duration
+        self.missing = sum(r.missing for r in results)
+        self.process_cpu = load.process_cpu
+        self.host_cpu = load.host_cpu
+
+        expected = duration * 1000.0 / period_ms
+        self.lossless = self.missing == 0 and all(r.rows >= 0.97 * expected for r in results)
+
+    def __str__(self):
+        host_cpu = 'n/a' if self.host_cpu is None else '{:.0f}%'.format(self.host_cpu)
+        return ('{:2} blocks at {:3} ms: {:4.0f} packets/s requested, {:4.0f} delivered, {} missing, {}, '
+                'cpu {:.0f}% process, {} host').format(
+                    self.blocks, self.period_ms, self.rate, self.delivered, self.missing,
+                    'lossless' if self.lossless else 'LOSS', self.process_cpu, host_cpu)
+
+
+def log_rate(cf, blocks: int, period_ms: int, duration=3.0) -> LogRateResult:
+    ''' Log with blocks full blocks at period_ms on a connected Crazyflie, and time every row '''
+    timings = dict()
+    configs = list()
+    for i in range(blocks):
+        config = init_log_max_bytes('Rate_%d' % i, period_ms)
+        timings[config.name] = BlockTiming(config.name, period_ms, duration)
+        configs.append(config)
+
+    def rate_cb(ts, data, config):
+        timings[config.name].record(ts)
+
+    try:
+        for config in configs:
+            cf.log.add_config(config)
+            config.data_received_cb.add_callback(rate_cb)
+
+        load = HostLoad()
+        for config in configs:
+            config.start()
+        time.sleep(duration)
+        for config in configs:
+            config.stop()
+        load.stop()
+
+        # Let rows still on their way arrive before the blocks are forgotten
+        deadline = time.monotonic() + 2.0
+        while time.monotonic() < deadline:
+            rows = sum(t.count for t in timings.values())
+            time.sleep(0.2)
+            if rows == sum(t.count for t in timings.values()):
+                break
+        results = [t.result() for t in timings.values()]
+    finally:
+        cf.log.reset()
+
+    result = LogRateResult(blocks, period_ms, duration, results, load)
+    logger.info('log rate: {}'.format(result))
+
+    return result
+
+
+def log_rate_candidates(max_blocks: int, periods=(10, 20, 50, 100)):
+    '''
+    The (blocks, period_ms) to try, sorted by packet rate. Of combinations
+    with the same rate, the one with the fewest blocks is kept.
+    '''
+    candidates = dict()
+    for period_ms in periods:
+        for blocks in range(1, max_blocks + 1):
+            rate = blocks * 1000.0 / period_ms
+            if rate not in candidates or blocks < candidates[rate][0]:
+                candidates[rate] = (blocks, period_ms)
+    return [candidates[rate] for rate in sorted(candidates)]
+
+
+def max_log_rate(cf, max_blocks: int, periods=(10, 20, 50, 100), duration=3.0):
+    '''
+    Bisect the candidate rates for the highest one delivered without loss,
+    assuming that if a rate is lossless so are all lower rates. Returns the
+    best LogRateResult, or None, and all results measured.
+    '''
+    candidates = log_rate_candidates(max_blocks, periods)
+    best = None
+    steps = list()
+
+    low, high = -1, len(candidates)
+    while high - low > 1:
+        mid = (low + high) // 2
+        result = log_rate(cf, *candidates[mid], duration)
+        steps.append(result)
+        if result.lossless:
+            low, best = mid, result
+        else:
+            high = mid
+
+    return best, steps
+
+
+def init_log_max_bytes(name='MaxGroup', period_ms=10):
+    ''' 7 variables * MAX_GROUPS (16) = 112 which is < MAX_VARIABLES (128) '''
+    config = LogConfig(name=name, period_in_ms=period_ms)
+    config.add_variable('stabilizer.roll', 'float')       # 04 bytes
+    config.add_variable('stabilizer.pitch', 'float')      # 08 bytes
+    config.add_variable('stabilizer.yaw', 'float')        # 12 bytes
+    config.add_variable('stabilizer.thrust', 'uint16_t')  # 14 bytes
+
+    config.add_variable('gyro.xVariance', 'float')        # 18 bytes
+    config.add_variable('gyro.yVariance', 'float')        # 22 bytes
+    config.add_variable('gyro.zVariance', 'float')        # 26 bytes
+
+    return config
@@ -11,6 +11,9 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
 import logging
 import os
 import sys
@@ -22,20 +25,41 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.join(currentdir, '..')
 sys.path.append(parentdir)
 
-from conftest import BCDevice, get_devices, get_bl_address  # noqa
+from conftest import BCDevice, get_devices, get_bl_address, save_bootloader_cache, bootloader_cache_path  # noqa
 
 logger = logging.getLogger(__name__)
 
 
-def list_addresses():
-    for dev in get_devices():
-        address = get_bl_address(dev)
+def list_addresses(missing: bool):
+    devices = get_devices()
+    if missing:
+        devices = [dev for dev in devices if dev.bl_link_uri is None]
+    if not devices:
+        return
+
+    # Ask all devices at once, each one can take seconds to answer
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        addresses = list(executor.map(get_bl_address, devices))
+
+    found = dict()
+    for dev, address in zip(devices, addresses):
         if address is None:
             print(f'{dev.name}: failed to get bootloader address')
             continue
 
-        print(f'{dev.name}: radio://0/0/2M/{address}?safelink=0')
+        found[dev.name] = dev.bl_uri(address)
+        dev.bl_link_uri = found[dev.name]
+        print(f'{dev.name}: {found[dev.name]}')
+
+    if found:
+        site = os.getenv('CRAZY_SITE')
+        save_bootloader_cache(site, found)
+        print(f'Saved to {bootloader_cache_path(site)}')
 
 
 if __name__ == "__main__":
-    list_addresses()
+    parser = argparse.ArgumentParser(description='Find the bootloader address of devices in site and cache them')
+    parser.add_argument('--missing', action='store_true', help='Only devices without a bootloader_radio')
+    p = parser.parse_args()
+
+    list_addresses(p.missing)
@@ -0,0 +1,49 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Probe all devices in the site at the same time and print a table with their
+status, echo round trip time and link quality. Exits with an error if any
+device does not answer.
+'''
+import argparse
+import logging
+import os
+import sys
+
+#
+# This is to make it possible to import from conftest
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from conftest import HealthReport, check_health, get_devices  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+def health(recover: bool) -> bool:
+    reports = check_health(get_devices(), recover)
+    print(HealthReport.table(reports))
+
+    return all(r.firmware for r in reports)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the health of all devices in site')
+    parser.add_argument('--recover', action='store_true', help='Start devices found in bootloader mode')
+    p = parser.parse_args()
+
+    if not health(p.recover):
+        sys.exit(1)
@@ -0,0 +1,109 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Find the highest log packet rate each device in the site delivers without
+loss, by bisecting over the number of full log blocks (up to logging.blocks
+max) and their period. The ceiling is recorded with the CPU load of the host
+while measuring it, and whether the decks of the device make it run the
+kalman estimator, since that limits the rate.
+
+Writes the results, and every step of the search, to <output>.json.
+'''
+from pathlib import Path
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+
+#
+# This is to make it possible to import from conftest and log_timing
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from conftest import BCDevice, get_devices, get_requirement  # noqa
+from log_timing import max_log_rate  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+def step_dict(result) -> dict:
+    return {
+        'blocks': result.blocks,
+        'period_ms': result.period_ms,
+        'rate': result.rate,
+        'delivered': result.delivered,
+        'missing': result.missing,
+        'lossless': result.lossless,
+        'process_cpu': result.process_cpu,
+        'host_cpu': result.host_cpu,
+    }
+
+
+def device_log_rate(dev: BCDevice, max_blocks: int, periods, duration: float) -> dict:
+    record = {'device': dev.name, 'decks': dev.decks, 'kalman_active': dev.kalman_active}
+
+    connected = dev.connect_sync()
+    if not connected:
+        print('{}: {}'.format(dev.name, connected), file=sys.stderr)
+        record['error'] = str(connected)
+        return record
+
+    try:
+        print('{}: {} kalman'.format(dev.name, 'with' if dev.kalman_active else 'without'))
+        best, steps = max_log_rate(dev.cf, max_blocks, periods, duration)
+        for step in steps:
+            print('  {}'.format(step))
+    finally:
+        dev.disconnect()
+
+    record['max_rate'] = best.rate if best else 0
+    record['best'] = step_dict(best) if best else None
+    record['steps'] = [step_dict(step) for step in steps]
+    print('{}: {:.0f} packets/s without loss'.format(dev.name, record['max_rate']))
+
+    return record
+
+
+def log_rate(output: Path, periods, duration: float) -> bool:
+    max_blocks = get_requirement('logging.blocks')['max']
+    records = [device_log_rate(dev, max_blocks, periods, duration) for dev in get_devices()]
+
+    host = {
+        'name': platform.node(),
+        'machine': platform.machine(),
+        'system': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+    }
+    with open(output.with_suffix('.json'), 'w') as f:
+        json.dump({'host': host, 'devices': records}, f, indent=2)
+
+    return all('error' not in record for record in records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the highest log rate without loss for all devices in site')
+    parser.add_argument('--output', type=Path, default=Path('log_rate'), help='Output path, without suffix')
+    parser.add_argument('--periods', nargs='+', type=int, default=[10, 20, 50, 100],
+                        help='Log block periods to combine with the block count, in ms (multiples of 10)')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds to log at each step of the search')
+    p = parser.parse_args()
+
+    if not log_rate(p.output, p.periods, p.duration):
+        sys.exit(1)
@@ -0,0 +1,205 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Take a snapshot of the values of all parameters of all devices in the site,
+and print the parameters the devices disagree on. All devices are connected
+in parallel, also those sharing a radio, and the TOCs come from the TOC cache,
+so run management/warm_toc_cache.py first after flashing.
+
+A snapshot can be saved, and later ones compared to it (--baseline), device by
+device or all against one reference device (--reference). Exits with an error
+if any value differs or a device could not be read.
+
+    python3 management/param_snapshot.py --output after_flash
+    python3 management/param_snapshot.py --baseline after_flash.json
+    python3 management/param_snapshot.py --load nightly.json --reference cf1
+'''
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+#
+# This is to make it possible to import from conftest
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from conftest import BCDevice, get_devices  # noqa
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Parameter values ("group.name" -> value as reported by cflib) per device
+Values = Dict[str, str]
+
+
+def fetch_values(dev: BCDevice) -> Values:
+    ''' All parameter values of dev, raises IOError if it can not connect '''
+    result = dev.connect_sync(wait_for_params=True)
+    try:
+        if not result:
+            raise IOError(str(result))
+        return {'{}.{}'.format(group, name): value
+                for group, params in dev.cf.param.values.items() for name, value in params.items()}
+    finally:
+        dev.disconnect()
+
+
+def take_snapshot(devices: List[BCDevice]) -> dict:
+    def fetch_device(dev):
+        try:
+            return dev.name, fetch_values(dev), None
+        except IOError as err:
+            return dev.name, None, str(err)
+
+    # cflib shares a radio between the links using it
+    with ThreadPoolExecutor(max_workers=len(devices) or 1) as executor:
+        fetched = list(executor.map(fetch_device, devices))
+
+    snapshot = {
+        'version': VERSION,
+        'site': os.getenv('CRAZY_SITE'),
+        'taken': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'devices': dict(),
+        'errors': dict(),
+    }
+    for name, values, error in fetched:
+        if values is None:
+            print('{}: {}'.format(name, error), file=sys.stderr)
+            snapshot['errors'][name] = error
+        else:
+            print('{}: {} parameters'.format(name, len(values)))
+            snapshot['devices'][name] = values
+    return snapshot
+
+
+def save_snapshot(path: Path, snapshot: dict):
+    with open(path, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'), sort_keys=True)
+
+
+def load_snapshot(path: Path) -> dict:
+    with open(path, 'r') as f:
+        snapshot = json.load(f)
+    if snapshot.get('version') != VERSION:
+        raise ValueError('{}: unsupported snapshot version {}'.format(path, snapshot.get('version')))
+    return snapshot
+
+
+def diff(columns: Dict[str, Values], ignore: List[str] = ()) -> Dict[str, List[Optional[str]]]:
+    '''
+    The parameters with different values in the columns, which are named sets
+    of values, with the value in each column (None if it does not have the
+    parameter). Parameters in the ignored groups are left out.
+    '''
+    ignored = tuple('{}.'.format(group) for group in ignore)
+    params = set()
+    for values in columns.values():
+        params.update(values)
+
+    differences = dict()
+    for param in sorted(params):
+        if param.startswith(ignored):
+            continue
+        row = [values.get(param) for values in columns.values()]
+        if len(set(row)) > 1:
+            differences[param] = row
+    return differences
+
+
+def print_diff(columns: Dict[str, Values], differences: Dict[str, List[Optional[str]]]):
+    names = list(columns)
+    param_width = max([len('parameter')] + [len(param) for param in differences])
+    widths = [max([len(name)] + [len(str(row[i])) for row in differences.values()]) for i, name in enumerate(names)]
+
+    print('  '.join(['{:{}}'.format('parameter', param_width)] +
+                    ['{:>{}}'.format(name, w) for name, w in zip(names, widths)]))
+    for param, row in differences.items():
+        print('  '.join(['{:{}}'.format(param, param_width)] +
+                        ['{:>{}}'.format('-' if v is None else v, w) for v, w in zip(row, widths)]))
+
+
+def compare(snapshot: dict, baseline: Optional[dict], reference: Optional[str], ignore: List[str]) -> bool:
+    '''
+    Print the differences, and return true if there are none. Without a
+    baseline or reference all devices are compared to each other.
+    '''
+    devices = snapshot['devices']
+    comparisons = list()  # (title, columns)
+
+    if reference is not None:
+        source = baseline if baseline is not None else snapshot
+        if reference not in source['devices']:
+            print('{}: not in snapshot'.format(reference), file=sys.stderr)
+            return False
+        ref = {'{} (reference)'.format(reference): source['devices'][reference]}
+        for name, values in devices.items():
+            if baseline is not None or name != reference:
+                comparisons.append((name, dict(ref, **{name: values})))
+    elif baseline is not None:
+        for name, values in devices.items():
+            if name not in baseline['devices']:
+                print('{}: not in baseline'.format(name), file=sys.stderr)
+                continue
+            comparisons.append((name, {'{} (baseline)'.format(name): baseline['devices'][name], name: values}))
+    else:
+        comparisons.append(('site', devices))
+
+    start = time.perf_counter()
+    results = [(title, columns, diff(columns, ignore)) for title, columns in comparisons]
+    logger.info('compared {} snapshots in {:.1f} ms'.format(len(comparisons), (time.perf_counter() - start) * 1000))
+
+    same = not snapshot['errors']
+    for title, columns, differences in results:
+        if not differences:
+            print('{}: no differences'.format(title))
+            continue
+        same = False
+        print('{}: {} differences'.format(title, len(differences)))
+        print_diff(columns, differences)
+
+    return same
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Snapshot the parameter values of all devices in site, and diff them')
+    parser.add_argument('--output', type=Path, default=Path('param_snapshot'), help='Output path, without suffix')
+    parser.add_argument('--load', type=Path, help='Diff a saved snapshot instead of taking one')
+    parser.add_argument('--baseline', type=Path, help='Snapshot to compare each device to')
+    parser.add_argument('--reference', help='Device to compare all devices to, from the baseline if given')
+    parser.add_argument('--ignore', nargs='*', default=[], help='Parameter groups to leave out of the diff')
+    p = parser.parse_args()
+
+    if p.load:
+        snapshot = load_snapshot(p.load)
+    else:
+        snapshot = take_snapshot(get_devices())
+        save_snapshot(p.output.with_suffix('.json'), snapshot)
+
+    baseline = load_snapshot(p.baseline) if p.baseline else None
+
+    if not compare(snapshot, baseline, p.reference, p.ignore):
+        sys.exit(1)
@@ -18,11 +18,6 @@ import traceback
 
 from pathlib import Path
 
-import cflib.crtp
-
-# Initiate the low level drivers
-cflib.crtp.init_drivers()
-
 #
 # This is to make it possible to import from conftest
 #
@@ -53,6 +48,8 @@ def program_swarm(fw_file: Path) -> bool:
             dev.flash(fw_file, progress_cb)
         except Exception as err:
             print('Programming failed: {}'.format(str(err)), file=sys.stderr)
+            if dev.uri_cache is not None:
+                dev.uri_cache.invalidate(dev.link_uri)
             traceback.print_exc()
             return False
 
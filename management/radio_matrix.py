@@ -0,0 +1,174 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Measure echo latency and throughput of every device in the site for a matrix
+of payload sizes, data rates and channels, by rewriting the channel and data
+rate of the device URI. The device must listen on a channel and data rate for
+it to be measured, points where it does not answer are marked unreachable.
+
+Writes <output>.csv with one row per point, and <output>.json with the rows
+and, per device, series over the payload sizes for plotting and the best
+configuration without timeouts.
+'''
+from pathlib import Path
+from urllib.parse import urlparse
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+#
+# This is to make it possible to import from conftest and echo
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from conftest import get_devices, init_drivers  # noqa
+from echo import bandwidth, latency  # noqa
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ['device', 'datarate', 'channel', 'packet_size', 'reachable',
+          'latency_min_ms', 'latency_p50_ms', 'latency_p99_ms', 'latency_max_ms',
+          'latency_jitter_ms', 'latency_timeouts', 'bandwidth', 'error']
+
+
+def with_channel_rate(uri: str, channel: int, datarate: str) -> str:
+    ''' Return uri with its channel and data rate replaced '''
+    parsed = urlparse(uri)
+    path = parsed.path.strip('/').split('/')
+    path[0:2] = [str(channel), datarate]
+    return parsed._replace(path='/' + '/'.join(path)).geturl()
+
+
+def reachable(uri: str) -> bool:
+    return latency(uri, 4, count=3, timeout=0.5).timeouts < 3
+
+
+def measure(name: str, uri: str, datarate: str, channel: int, sizes, count: int, bw_count: int, window,
+            pattern: str):
+    rows = list()
+    uri = with_channel_rate(uri, channel, datarate)
+    ok = reachable(uri)
+    print(f'{name} @ {uri}: {"reachable" if ok else "unreachable"}')
+
+    for size in sizes:
+        row = {'device': name, 'datarate': datarate, 'channel': channel,
+               'packet_size': size, 'reachable': ok}
+        rows.append(row)
+        if not ok:
+            continue
+
+        try:
+            lat = latency(uri, size, count, pattern=pattern)
+            row.update({
+                'latency_min_ms': lat.min,
+                'latency_p50_ms': lat.p50,
+                'latency_p99_ms': lat.p99,
+                'latency_max_ms': lat.max,
+                'latency_jitter_ms': lat.jitter,
+                'latency_timeouts': lat.timeouts,
+            })
+            row['bandwidth'] = bandwidth(uri, size, bw_count, window, pattern=pattern).rate
+        except Exception as err:
+            row['error'] = str(err)
+
+        print('  {:2} bytes: p50 {:.2f} ms, p99 {:.2f} ms, {:.0f} packets/s {}'.format(
+            size, row.get('latency_p50_ms', float('nan')), row.get('latency_p99_ms', float('nan')),
+            row.get('bandwidth', float('nan')), row.get('error', '')))
+
+    return rows
+
+
+def summarize(rows) -> dict:
+    '''
+    Per device, one series per data rate and channel with the values for
+    each payload size, and the configuration with the best throughput for
+    the largest payload among those without timeouts or errors.
+    '''
+    summary = dict()
+    for row in rows:
+        device = summary.setdefault(row['device'], {'series': {}, 'best': None})
+        key = '{}/{}'.format(row['datarate'], row['channel'])
+        series = device['series'].setdefault(key, {
+            'datarate': row['datarate'], 'channel': row['channel'], 'reachable': row['reachable'],
+            'packet_size': [], 'latency_p50_ms': [], 'latency_p99_ms': [], 'bandwidth': []})
+        for field in ('packet_size', 'latency_p50_ms', 'latency_p99_ms', 'bandwidth'):
+            series[field].append(row.get(field))
+
+    for name, device in summary.items():
+        clean = list()
+        for series in device['series'].values():
+            points = [r for r in rows if r['device'] == name and r['datarate'] == series['datarate'] and
+                      r['channel'] == series['channel']]
+            if all(r['reachable'] and not r.get('error') and r.get('latency_timeouts') == 0 for r in points):
+                largest = max(points, key=lambda r: r['packet_size'])
+                clean.append((largest['bandwidth'], -largest['latency_p99_ms'], series))
+
+        if clean:
+            _, _, best = max(clean, key=lambda c: (c[0], c[1]))
+            device['best'] = {'datarate': best['datarate'], 'channel': best['channel']}
+
+    return summary
+
+
+def radio_matrix(output: Path, datarates, channels, sizes, count: int, bw_count: int, window,
+                 pattern: str) -> bool:
+    init_drivers()
+    rows = list()
+    for dev in get_devices():
+        dev_channels = channels or [int(urlparse(dev.link_uri).path.strip('/').split('/')[0])]
+        for datarate in datarates:
+            for channel in dev_channels:
+                rows.extend(measure(dev.name, dev.link_uri, datarate, channel, sizes, count, bw_count, window,
+                                    pattern))
+
+    with open(output.with_suffix('.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    summary = summarize(rows)
+    with open(output.with_suffix('.json'), 'w') as f:
+        json.dump({'rows': rows, 'summary': summary}, f, indent=2)
+
+    for name, device in summary.items():
+        print(f'{name}: best configuration {device["best"]}')
+
+    return any(row['reachable'] for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure radio latency and throughput over payload sizes, '
+                                                 'data rates and channels for all devices in site')
+    parser.add_argument('--output', type=Path, default=Path('radio_matrix'),
+                        help='Output path, without suffix, for the CSV and JSON files')
+    parser.add_argument('--datarates', nargs='+', default=['250K', '1M', '2M'], choices=['250K', '1M', '2M'])
+    parser.add_argument('--channels', nargs='+', type=int, default=None,
+                        help='Channels to measure on (default: the channel of each device)')
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(range(4, 29, 4)),
+                        help='Payload sizes in bytes, multiples of 4')
+    parser.add_argument('--count', type=int, default=200, help='Echo packets per latency measurement')
+    parser.add_argument('--bw-count', type=int, default=500, help='Echo packets per throughput measurement')
+    parser.add_argument('--window', type=int, default=None, help='Packets in flight when measuring throughput')
+    parser.add_argument('--pattern', default='sequence', choices=['sequence', 'random'],
+                        help='Payload after the sequence number')
+    p = parser.parse_args()
+
+    if not radio_matrix(p.output, p.datarates, p.channels, p.sizes, p.count, p.bw_count, p.window, p.pattern):
+        sys.exit(1)
@@ -17,17 +17,23 @@ from conftest import BCDevice, get_devices  # noqa
 logger = logging.getLogger(__name__)
 
 
-def reboot(name: str):
+def reboot(name: str, wait: bool) -> bool:
+    ok = True
     for dev in get_devices():
         if not name or (name and dev.name == name):
             print(f'Rebooting {dev.name}')
-            dev.reboot()
-
+            result = dev.reboot(wait=wait)
+            if result is not None:
+                print(f'{dev.name}: {result}')
+                ok = ok and bool(result)
+    return ok
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Reboot devices')
     parser.add_argument('--name', type=Path, help='device to reboot')
+    parser.add_argument('--wait', action='store_true', help='wait for the devices to boot and print the boot times')
     p = parser.parse_args()
 
-    reboot(p.name)
+    if not reboot(p.name, p.wait):
+        sys.exit(1)
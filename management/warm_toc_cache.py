@@ -0,0 +1,71 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Connect once to every device in the site so their log and param TOCs are in
+the shared TOC cache (CRAZY_TOC_CACHE) before the test suite runs. Run it
+right after flashing new firmware. All devices are connected in parallel,
+also those sharing a radio.
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+#
+# This is to make it possible to import from conftest
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from conftest import BCDevice, TOC_CACHE, get_devices, toc_cache_stats  # noqa
+
+logger = logging.getLogger(__name__)
+
+
+def warm_device(dev: BCDevice, retries: int) -> bool:
+    for attempt in range(retries + 1):
+        result = dev.connect_sync()
+        dev.disconnect()
+        if result:
+            print('{}: {}'.format(dev.name, result))
+            return True
+
+        print('{}: {}'.format(dev.name, result), file=sys.stderr)
+        # The device might still be booting after being flashed
+        time.sleep(1)
+
+    return False
+
+
+def warm(retries: int) -> bool:
+    devices = get_devices()
+    # cflib shares a radio between the links using it
+    with ThreadPoolExecutor(max_workers=len(devices) or 1) as executor:
+        results = list(executor.map(lambda dev: warm_device(dev, retries), devices))
+
+    print('TOC cache {}: {}'.format(TOC_CACHE, toc_cache_stats))
+    return all(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download the TOCs of all devices in site to the TOC cache')
+    parser.add_argument('--retries', type=int, default=2, help='Connection attempts per device after the first')
+    p = parser.parse_args()
+
+    if not warm(p.retries):
+        sys.exit(1)
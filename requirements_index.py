@@ -0,0 +1,285 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+The requirements in requirements/*.toml compiled to a flat, validated index
+of "group.name" -> Requirement. The index is cached in requirements/.index.json
+keyed by a hash of the TOML files, so the TOML is only parsed and validated
+again when a file changes. It only depends on toml, since it is also used by
+utils/render_requirements.py.
+'''
+import glob
+import hashlib
+import json
+import logging
+import os
+import toml
+
+from typing import Dict
+from typing import List
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+REQUIREMENT = os.path.join(DIR, 'requirements/')
+INDEX = os.path.join(REQUIREMENT, '.index.json')
+
+# Bump when the index format changes, to recompile old indexes
+INDEX_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class RequirementError(Exception):
+    pass
+
+
+class Requirement:
+    '''
+    A requirement, like radio.bwsmall. The fields of the TOML table, such as
+    packet_size or limit_low, are read as requirement['limit_low'].
+    '''
+
+    def __init__(self, group: str, name: str, fields: dict):
+        self.group = group
+        self.name = name
+        self.fields = fields
+
+    @property
+    def id(self) -> str:
+        return '{}.{}'.format(self.group, self.name)
+
+    @property
+    def description(self) -> str:
+        return self.fields['description']
+
+    @property
+    def rational(self) -> str:
+        return self.fields['rational']
+
+    @property
+    def background(self) -> str:
+        return self.fields.get('background', '')
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def __repr__(self):
+        return 'Requirement({})'.format(self.id)
+
+
+class Group:
+    ''' A group of requirements, the TOML file it is defined in and its fields '''
+
+    def __init__(self, name: str, file: str, fields: dict):
+        self.name = name
+        self.file = file
+        self.fields = fields
+        self.requirements = list()  # type: List[Requirement]
+
+    @property
+    def description(self) -> str:
+        return self.fields['description']
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _positive_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+#
+# The schema. Fields named limit_* must be numbers, and the fields below
+# must pass their check when present.
+#
+FIELD_CHECKS = {
+    'description': lambda v: isinstance(v, str) and v.strip() != '',
+    'rational': lambda v: v in ('Design', 'Empirical'),
+    'background': lambda v: isinstance(v, str),
+    'packet_size': lambda v: _positive_int(v) and v <= 30,
+    'iterations': _positive_int,
+    'max': _positive_int,
+    'max_payload': _positive_int,
+    'max_rate': lambda v: _number(v) and v > 0,
+    'window': _positive_int,
+    'groups': lambda v: isinstance(v, list) and all(isinstance(g, str) for g in v),
+}
+
+REQUIRED_FIELDS = ('description', 'rational')
+
+# Per group, fields where at least one in each tuple must be present
+GROUP_FIELDS = {
+    'radio': (('limit_low', 'limit_high_ms'),),
+}
+
+
+def _validate(req: Requirement) -> List[str]:
+    errors = list()
+    for field in REQUIRED_FIELDS:
+        if field not in req:
+            errors.append('{}: missing {}'.format(req.id, field))
+
+    for field, value in req.fields.items():
+        if isinstance(value, dict):
+            errors.append('{}: {} is nested too deep'.format(req.id, field))
+        elif field.startswith('limit_') and not _number(value):
+            errors.append('{}: {} must be a number, not {!r}'.format(req.id, field, value))
+        elif field in FIELD_CHECKS and not FIELD_CHECKS[field](value):
+            errors.append('{}: invalid {} {!r}'.format(req.id, field, value))
+
+    for alternatives in GROUP_FIELDS.get(req.group, ()):
+        if not any(field in req for field in alternatives):
+            errors.append('{}: needs one of {}'.format(req.id, ', '.join(alternatives)))
+
+    return errors
+
+
+class RequirementIndex:
+    '''
+    All requirements by id ("group.name"), and all groups by name. Use
+    instance() to get the index for the requirements folder.
+    '''
+    _instance = None
+
+    def __init__(self, groups: Dict[str, Group]):
+        self.groups = groups
+        self.requirements = dict()  # type: Dict[str, Requirement]
+        for group in groups.values():
+            for req in group.requirements:
+                self.requirements[req.id] = req
+
+    def __getitem__(self, requirement: str) -> Requirement:
+        return self.requirements[requirement]
+
+    def __contains__(self, requirement: str) -> bool:
+        return requirement in self.requirements
+
+    def __iter__(self):
+        return iter(self.requirements.values())
+
+    def files(self) -> List[str]:
+        ''' The TOML files in the index, sorted '''
+        return sorted({group.file for group in self.groups.values()})
+
+    def groups_in(self, file: str) -> List[Group]:
+        ''' The groups defined in a TOML file, in the order of the file '''
+        return [group for group in self.groups.values() if group.file == file]
+
+    @staticmethod
+    def source_hash(path: str = REQUIREMENT) -> str:
+        sha = hashlib.sha1(str(INDEX_VERSION).encode())
+        for filename in sorted(glob.glob(os.path.join(path, '*.toml'))):
+            sha.update(os.path.basename(filename).encode())
+            with open(filename, 'rb') as f:
+                sha.update(hashlib.sha1(f.read()).digest())
+        return sha.hexdigest()
+
+    @classmethod
+    def compile(cls, path: str = REQUIREMENT) -> 'RequirementIndex':
+        ''' Parse and validate the TOML files, raises RequirementError '''
+        groups = dict()
+        errors = list()
+        for filename in sorted(glob.glob(os.path.join(path, '*.toml'))):
+            file = os.path.basename(filename)
+            try:
+                data = toml.load(filename)
+            except Exception as err:
+                raise RequirementError('{}: {}'.format(file, err))
+
+            for name, table in data.get('requirement', {}).items():
+                if name in groups:
+                    errors.append('{}: group {} is already defined in {}'.format(
+                        file, name, groups[name].file))
+                    continue
+
+                fields = {k: v for k, v in table.items() if not isinstance(v, dict)}
+                group = Group(name, file, fields)
+                if 'description' not in fields:
+                    errors.append('{}: group {} has no description'.format(file, name))
+
+                for req_name, req_fields in table.items():
+                    if isinstance(req_fields, dict):
+                        req = Requirement(name, req_name, req_fields)
+                        errors.extend(_validate(req))
+                        group.requirements.append(req)
+
+                groups[name] = group
+
+        if errors:
+            raise RequirementError('Invalid requirements:\n  ' + '\n  '.join(errors))
+
+        return cls(groups)
+
+    def _to_json(self, key: str) -> dict:
+        return {
+            'key': key,
+            'groups': [{
+                'name': group.name,
+                'file': group.file,
+                'fields': group.fields,
+                'requirements': [{'name': req.name, 'fields': req.fields}
+                                 for req in group.requirements],
+            } for group in self.groups.values()],
+        }
+
+    @classmethod
+    def _from_json(cls, data: dict) -> 'RequirementIndex':
+        groups = dict()
+        for g in data['groups']:
+            group = Group(g['name'], g['file'], g['fields'])
+            group.requirements = [Requirement(group.name, r['name'], r['fields'])
+                                  for r in g['requirements']]
+            groups[group.name] = group
+        return cls(groups)
+
+    @classmethod
+    def load(cls, path: str = REQUIREMENT, index: str = INDEX) -> 'RequirementIndex':
+        ''' Load the cached index, or compile and cache it if a TOML file changed '''
+        key = cls.source_hash(path)
+        try:
+            with open(index, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == key:
+                return cls._from_json(data)
+        except (OSError, ValueError, KeyError):
+            pass
+
+        compiled = cls.compile(path)
+        tmp = '{}.{}.tmp'.format(index, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(compiled._to_json(key), f)
+            os.replace(tmp, index)
+        except OSError as err:
+            logger.warning('Failed to save requirement index {}: {}'.format(index, err))
+
+        return compiled
+
+    @classmethod
+    def instance(cls) -> 'RequirementIndex':
+        if cls._instance is None:
+            cls._instance = cls.load()
+        return cls._instance
+
+
+if __name__ == "__main__":
+    for req in RequirementIndex.compile():
+        print('{:32} {}'.format(req.id, ', '.join(
+            '{}={}'.format(k, v) for k, v in req.fields.items()
+            if k not in ('description', 'rational', 'background'))))
@@ -0,0 +1,40 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Simulated Crazyflies for running the test suite without radios. Use a site
+with `sim://` URIs, for example `CRAZY_SITE=sim`.
+'''
+import cflib.crtp
+
+from .device import VirtualCrazyflie, get_device  # noqa
+from .driver import SimDriver, URI_SCHEME, parse_uri  # noqa
+
+
+def init_drivers():
+    '''
+    Register the sim driver with cflib. It is put first so that it can claim
+    the radio:// bootloader URIs of simulated devices.
+    '''
+    if SimDriver not in cflib.crtp.CLASSES:
+        cflib.crtp.CLASSES.insert(0, SimDriver)
+
+
+def is_sim_uri(uri: str) -> bool:
+    return uri is not None and uri.startswith(URI_SCHEME)
+
+
+def configure(uri: str, **kwargs):
+    ''' Configure the virtual Crazyflie behind a sim:// URI, see VirtualCrazyflie.configure() '''
+    _, _, _, address, _ = parse_uri(uri)
+    get_device(address).configure(**kwargs)
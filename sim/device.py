@@ -0,0 +1,606 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+An in-process virtual Crazyflie. It answers the subset of CRTP that the QA
+suite uses: link control (echo and protocol discovery), platform version,
+memory info, the log and param subsystems (TOC, blocks, values and the
+persistent store) and the nRF51/bootloader commands on port 0xF channel 3.
+'''
+import errno
+import struct
+import threading
+import time
+import zlib
+
+from cflib.bootloader.boottypes import BootVersion
+from cflib.bootloader.boottypes import TargetTypes
+from cflib.crazyflie import log
+from cflib.crazyflie import param
+from cflib.crazyflie import toc
+from cflib.crazyflie.log import LogTocElement
+from cflib.crazyflie.param import ParamTocElement
+from cflib.crtp.crtpstack import CRTPPacket
+from cflib.crtp.crtpstack import CRTPPort
+
+PROTOCOL_VERSION = 11
+BOOT_TIME = 0.5  # seconds from power on until the firmware answers
+
+FIRMWARE = 'firmware'
+BOOTLOADER = 'bootloader'
+
+BOOTLOADER_HEADER = 0xFF
+BOOTLOADER_CMD_SYSOFF = 0x02
+BOOTLOADER_CMD_SYSON = 0x03
+BOOTLOADER_CMD_GET_INFO = 0x10
+BOOTLOADER_CMD_LOAD_BUFFER = 0x14
+BOOTLOADER_CMD_WRITE_FLASH = 0x18
+BOOTLOADER_CMD_READ_FLASH = 0x1C
+BOOTLOADER_CMD_RESET = 0xF0
+BOOTLOADER_CMD_RESET_INIT = 0xFF
+
+LINKCTRL_ECHO = 0
+LINKCTRL_SOURCE = 1
+PLATFORM_VERSION_COMMAND = 1
+MEM_CHAN_INFO = 0
+MEM_CMD_INFO_NBR = 1
+
+# page_size, buffer_pages, flash_pages, start_page
+BOOTLOADER_TARGETS = {
+    TargetTypes.STM32: (1024, 10, 1024, 16),
+    TargetTypes.NRF51: (1024, 10, 232, 88),
+}
+
+#
+# (group, name, type, value)
+#
+LOG_TOC = [
+    ('stabilizer', 'roll', 'float', 0.5),
+    ('stabilizer', 'pitch', 'float', -0.25),
+    ('stabilizer', 'yaw', 'float', 12.0),
+    ('stabilizer', 'thrust', 'float', 0.0),
+    ('gyro', 'x', 'float', 0.01),
+    ('gyro', 'y', 'float', -0.02),
+    ('gyro', 'z', 'float', 0.0),
+    ('gyro', 'xVariance', 'float', 0.001),
+    ('gyro', 'yVariance', 'float', 0.001),
+    ('gyro', 'zVariance', 'float', 0.001),
+    ('acc', 'x', 'float', 0.0),
+    ('acc', 'y', 'float', 0.0),
+    ('acc', 'z', 'float', 1.0),
+    ('sys', 'canfly', 'uint8_t', 1),
+    ('sys', 'isFlying', 'uint8_t', 0),
+    ('sys', 'isTumbled', 'uint8_t', 0),
+    ('radio', 'rssi', 'uint8_t', 40),
+    ('radio', 'isConnected', 'uint8_t', 1),
+    ('pm', 'vbat', 'float', 4.1),
+    ('pm', 'batteryLevel', 'uint8_t', 90),
+    ('pm', 'state', 'int8_t', 0),
+    ('health', 'motorPass', 'uint8_t', 15),
+    ('health', 'batteryPass', 'uint8_t', 1),
+    ('stateEstimate', 'x', 'float', 0.0),
+    ('stateEstimate', 'y', 'float', 0.0),
+    ('stateEstimate', 'z', 'float', 0.0),
+]
+
+PARAM_RO = 0x40
+PARAM_EXTENDED = 0x10
+
+DECKS = [
+    'bcAI', 'bcActiveMarker', 'bcBuzzer', 'bcDWM1000', 'bcFlow', 'bcFlow2',
+    'bcLedRing', 'bcLighthouse4', 'bcMultiranger', 'bcUSD', 'bcZRanger',
+    'bcZRanger2',
+]
+
+#
+# (group, name, type, default value, flags)
+#
+PARAM_TOC = [
+    ('stabilizer', 'estimator', 'uint8_t', 1, 0),
+    ('stabilizer', 'controller', 'uint8_t', 1, 0),
+    ('stabilizer', 'stop', 'uint8_t', 0, 0),
+    ('commander', 'enHighLevel', 'uint8_t', 1, 0),
+    ('sound', 'effect', 'uint8_t', 0, PARAM_EXTENDED),
+    ('sound', 'freq', 'uint16_t', 4000, 0),
+    ('ring', 'effect', 'uint8_t', 6, PARAM_EXTENDED),
+    ('ring', 'fadeTime', 'float', 0.5, 0),
+    ('pid_rate', 'roll_kp', 'float', 250.0, PARAM_EXTENDED),
+    ('pid_rate', 'pitch_kp', 'float', 250.0, PARAM_EXTENDED),
+    ('pid_rate', 'yaw_kp', 'float', 120.0, PARAM_EXTENDED),
+    ('system', 'selftestPassed', 'uint8_t', 1, PARAM_RO),
+    ('cpu', 'flash', 'uint16_t', 1024, PARAM_RO),
+    ('firmware', 'revision0', 'uint32_t', 0xC0FFEE, PARAM_RO),
+] + [('deck', name, 'uint8_t', 0, PARAM_RO) for name in DECKS]
+
+
+def _log_type_id(ctype):
+    return LogTocElement.get_id_from_cstring(ctype)
+
+
+def _param_type_id(ctype):
+    for ident, (name, _) in ParamTocElement.types.items():
+        if name == ctype:
+            return ident
+    raise KeyError(ctype)
+
+
+def _toc_crc(items):
+    crc = 0
+    for item in items:
+        crc = zlib.crc32(item, crc)
+    return crc
+
+
+def _toc_name(group, name):
+    return group.encode('ISO-8859-1') + b'\0' + name.encode('ISO-8859-1') + b'\0'
+
+
+class _LogBlock:
+    def __init__(self, ident, owner):
+        self.ident = ident
+        self.owner = owner
+        self.variables = []  # (toc index, fetch type id)
+        self.period = 0.0
+        self.next_ts = None
+        self.struct = None
+
+    def append(self, data):
+        for i in range(0, len(data) - 2, 3):
+            fetch_as = data[i] & 0x0F
+            index, = struct.unpack('<H', data[i + 1:i + 3])
+            self.variables.append((index, fetch_as))
+        fmt = '<' + ''.join(
+            LogTocElement.types[fetch_as][1][1] for _, fetch_as in self.variables
+        )
+        self.struct = struct.Struct(fmt)
+
+    def size(self):
+        return sum(LogTocElement.get_size_from_id(t) for _, t in self.variables)
+
+
+class VirtualCrazyflie:
+    '''
+    A simulated Crazyflie reachable on `address` while running the firmware
+    and on `bl_address` while in the bootloader. Packets are handled
+    synchronously by `handle()` and answered through the link that sent them.
+    '''
+
+    def __init__(self, address: str, decks=None, boot_time=BOOT_TIME):
+        self.address = address.upper()
+        self.bl_address = 'B1' + self.address[2:]
+        self.decks = list(decks or [])
+        self.boot_time = boot_time
+
+        self.mode = FIRMWARE
+        self._stm_on = True
+        self._ready_at = 0.0
+        self._clock_start = time.monotonic()
+
+        self._lock = threading.RLock()
+        self._log_cond = threading.Condition(self._lock)
+        self._log_thread = None
+
+        self._log_items = [
+            struct.pack('<B', _log_type_id(ctype)) + _toc_name(group, name)
+            for group, name, ctype, _ in LOG_TOC
+        ]
+        self._log_values = [value for _, _, _, value in LOG_TOC]
+        self._log_crc = _toc_crc(self._log_items)
+        self._log_blocks = {}
+
+        self._param_items = [
+            struct.pack('<B', _param_type_id(ctype) | flags) + _toc_name(group, name)
+            for group, name, ctype, _, flags in PARAM_TOC
+        ]
+        self._param_types = [
+            ParamTocElement.types[_param_type_id(ctype)][1]
+            for _, _, ctype, _, _ in PARAM_TOC
+        ]
+        self._param_crc = _toc_crc(self._param_items)
+        self._param_values = []
+        self.eeprom = {}
+
+        with self._lock:
+            self._reset_ram()
+
+    def configure(self, decks=None, boot_time=None):
+        with self._lock:
+            if boot_time is not None:
+                self.boot_time = boot_time
+            if decks is not None and list(decks) != self.decks:
+                self.decks = list(decks)
+                self._reset_ram()
+
+    def reachable(self, address: str) -> bool:
+        ''' True if the nRF51 acknowledges packets sent to address '''
+        if address == self.address:
+            return self.mode == FIRMWARE
+        if address == self.bl_address:
+            return self.mode == BOOTLOADER
+        return False
+
+    def firmware_running(self) -> bool:
+        return (self.mode == FIRMWARE and self._stm_on and
+                time.monotonic() >= self._ready_at)
+
+    def detach(self, link):
+        ''' Stop streaming log data to a link that is being closed '''
+        with self._lock:
+            for block in self._log_blocks.values():
+                if block.owner is link:
+                    block.next_ts = None
+
+    def handle(self, pk: CRTPPacket, link):
+        with self._lock:
+            # Bootloader packets are built with set_header(0xFF, 0xFF), so
+            # only the header byte is reliable
+            if pk.get_header() == BOOTLOADER_HEADER:
+                self._handle_bootloader(pk, link)
+                return
+
+            if not self.firmware_running():
+                return
+
+            if pk.port == CRTPPort.LINKCTRL:
+                self._handle_linkctrl(pk, link)
+            elif pk.port == CRTPPort.PLATFORM:
+                self._handle_platform(pk, link)
+            elif pk.port == CRTPPort.MEM:
+                self._handle_mem(pk, link)
+            elif pk.port == CRTPPort.LOGGING:
+                self._handle_log(pk, link)
+            elif pk.port == CRTPPort.PARAM:
+                self._handle_param(pk, link)
+
+    #
+    # Power and boot
+    #
+
+    def _reset_ram(self):
+        self._param_values = [default for _, _, _, default, _ in PARAM_TOC]
+        for i, (group, name, _, _, _) in enumerate(PARAM_TOC):
+            if group == 'deck' and name in self.decks:
+                self._param_values[i] = 1
+        for index, value in self.eeprom.items():
+            self._param_values[index] = value
+        self._log_blocks = {}
+        self._log_cond.notify_all()
+
+    def _boot(self, mode):
+        self.mode = mode
+        self._stm_on = True
+        now = time.monotonic()
+        self._ready_at = now + self.boot_time
+        self._clock_start = self._ready_at
+        self._reset_ram()
+
+    def _timestamp(self, at=None):
+        at = time.monotonic() if at is None else at
+        return int((at - self._clock_start) * 1000) & 0xFFFFFF
+
+    #
+    # Bootloader and nRF51 commands (port 0xF, channel 3)
+    #
+
+    def _handle_bootloader(self, pk, link):
+        if len(pk.data) < 2:
+            return
+        target, cmd = pk.data[0], pk.data[1]
+
+        def reply(data):
+            link.deliver(CRTPPacket(BOOTLOADER_HEADER, [target, cmd] + list(data)))
+
+        if cmd == BOOTLOADER_CMD_RESET_INIT:
+            address = bytes.fromhex(self.bl_address[2:])[::-1]
+            reply(address)
+        elif cmd == BOOTLOADER_CMD_RESET and len(pk.data) > 2:
+            self._boot(FIRMWARE if pk.data[2] else BOOTLOADER)
+            if self.mode == BOOTLOADER:
+                self._ready_at = time.monotonic()
+        elif cmd == BOOTLOADER_CMD_SYSOFF and self.mode == FIRMWARE:
+            self._stm_on = False
+            self._reset_ram()
+            reply([])
+        elif cmd == BOOTLOADER_CMD_SYSON and self.mode == FIRMWARE:
+            self._boot(FIRMWARE)
+            reply([])
+        elif self.mode != BOOTLOADER:
+            return
+        elif cmd == BOOTLOADER_CMD_GET_INFO and target in BOOTLOADER_TARGETS:
+            info = struct.pack('<HHHH', *BOOTLOADER_TARGETS[target])
+            cpuid = bytes(range(12))
+            version = struct.pack('<BHBB', BootVersion.CF2_PROTO_VER, 2021, 6, 0)
+            reply(info + cpuid + version)
+        elif cmd == BOOTLOADER_CMD_WRITE_FLASH:
+            reply([1, 0])  # done, no error
+        elif cmd == BOOTLOADER_CMD_READ_FLASH:
+            reply(pk.data[2:6] + bytes(25))
+
+    #
+    # Firmware ports
+    #
+
+    def _handle_linkctrl(self, pk, link):
+        if pk.channel == LINKCTRL_ECHO:
+            echo = CRTPPacket()
+            echo.set_header(CRTPPort.LINKCTRL, LINKCTRL_ECHO)
+            echo.data = bytes(pk.data)
+            link.deliver(echo)
+        elif pk.channel == LINKCTRL_SOURCE:
+            source = CRTPPacket()
+            source.set_header(CRTPPort.LINKCTRL, LINKCTRL_SOURCE)
+            source.data = b'Bitcraze Crazyflie'
+            link.deliver(source)
+
+    def _handle_platform(self, pk, link):
+        if pk.channel == PLATFORM_VERSION_COMMAND and pk.data and pk.data[0] == 0:
+            version = CRTPPacket()
+            version.set_header(CRTPPort.PLATFORM, PLATFORM_VERSION_COMMAND)
+            version.data = (0, PROTOCOL_VERSION)
+            link.deliver(version)
+
+    def _handle_mem(self, pk, link):
+        if pk.channel == MEM_CHAN_INFO and pk.data and pk.data[0] == MEM_CMD_INFO_NBR:
+            info = CRTPPacket()
+            info.set_header(CRTPPort.MEM, MEM_CHAN_INFO)
+            info.data = (MEM_CMD_INFO_NBR, 0)
+            link.deliver(info)
+
+    def _toc(self, pk, link, items, crc):
+        cmd = pk.data[0]
+        answer = CRTPPacket()
+        answer.set_header(pk.port, toc.TOC_CHANNEL)
+        if cmd == toc.CMD_TOC_INFO_V2:
+            answer.data = struct.pack('<BHI', cmd, len(items), crc)
+        elif cmd == toc.CMD_TOC_INFO:
+            answer.data = struct.pack('<BBI', cmd, len(items), crc)
+        elif cmd == toc.CMD_TOC_ITEM_V2:
+            index, = struct.unpack('<H', pk.data[1:3])
+            if index >= len(items):
+                return
+            answer.data = struct.pack('<BH', cmd, index) + items[index]
+        elif cmd == toc.CMD_TOC_ELEMENT:
+            index = pk.data[1]
+            if index >= len(items):
+                return
+            answer.data = struct.pack('<BB', cmd, index) + items[index]
+        else:
+            return
+        link.deliver(answer)
+
+    def _handle_log(self, pk, link):
+        if pk.channel == toc.TOC_CHANNEL:
+            self._toc(pk, link, self._log_items, self._log_crc)
+        elif pk.channel == log.CHAN_SETTINGS:
+            cmd = pk.data[0]
+            ident = pk.data[1] if len(pk.data) > 1 else 0
+            status = self._log_settings(cmd, ident, pk.data[2:], link)
+            if status is None:
+                return
+            answer = CRTPPacket()
+            answer.set_header(CRTPPort.LOGGING, log.CHAN_SETTINGS)
+            answer.data = (cmd, ident, status)
+            link.deliver(answer)
+
+    def _log_settings(self, cmd, ident, data, link):
+        blocks = self._log_blocks
+
+        if cmd == log.CMD_RESET_LOGGING:
+            self._log_blocks = {}
+            return 0
+        if cmd == log.CMD_CREATE_BLOCK_V2:
+            if ident in blocks:
+                return errno.EEXIST
+            if len(blocks) >= log.Log.MAX_BLOCKS:
+                return errno.ENOMEM
+            block = _LogBlock(ident, link)
+            block.append(data)
+            return self._check_log_block(block)
+        if cmd == log.CMD_APPEND_BLOCK_V2:
+            if ident not in blocks:
+                return errno.ENOENT
+            block = blocks.pop(ident)
+            block.append(data)
+            return self._check_log_block(block)
+        if ident not in blocks:
+            return errno.ENOENT if cmd in (log.CMD_START_LOGGING,
+                                           log.CMD_STOP_LOGGING,
+                                           log.CMD_DELETE_BLOCK) else errno.ENOEXEC
+        block = blocks[ident]
+        if cmd == log.CMD_START_LOGGING:
+            block.owner = link
+            block.period = max(data[0], 1) * 10 / 1000.0 if data else 0.01
+            # The first row is sent right away, then once every period
+            block.next_ts = time.monotonic()
+            self._start_log_thread()
+            self._log_cond.notify_all()
+            return 0
+        if cmd == log.CMD_STOP_LOGGING:
+            block.next_ts = None
+            return 0
+        if cmd == log.CMD_DELETE_BLOCK:
+            del blocks[ident]
+            return 0
+        return errno.ENOEXEC
+
+    def _check_log_block(self, block):
+        nbr_of_variables = sum(len(b.variables) for b in self._log_blocks.values())
+        if nbr_of_variables + len(block.variables) > log.Log.MAX_VARIABLES:
+            return errno.ENOMEM
+        if block.size() > log.LogConfig.MAX_LEN:
+            return errno.E2BIG
+        if any(index >= len(LOG_TOC) for index, _ in block.variables):
+            return errno.ENOENT
+        self._log_blocks[block.ident] = block
+        return 0
+
+    def _start_log_thread(self):
+        if self._log_thread is None or not self._log_thread.is_alive():
+            self._log_thread = threading.Thread(
+                target=self._log_loop,
+                name=f'VirtualCrazyflieLog-{self.address}',
+                daemon=True
+            )
+            self._log_thread.start()
+
+    def _log_loop(self):
+        with self._lock:
+            while True:
+                running = [b for b in self._log_blocks.values() if b.next_ts is not None]
+                if not running:
+                    if not self._log_cond.wait(timeout=5.0):
+                        self._log_thread = None
+                        return
+                    continue
+
+                now = time.monotonic()
+                block = min(running, key=lambda b: b.next_ts)
+                if block.next_ts > now:
+                    self._log_cond.wait(timeout=block.next_ts - now)
+                    continue
+
+                # Like the firmware, rows are stamped with the tick that triggered them
+                tick = block.next_ts
+                block.next_ts += block.period
+                if not self.firmware_running():
+                    continue
+
+                values = [self._log_values[index] if fetch_as in (0x07, 0x08)
+                          else int(self._log_values[index])
+                          for index, fetch_as in block.variables]
+                data = CRTPPacket()
+                data.set_header(CRTPPort.LOGGING, log.CHAN_LOGDATA)
+                data.data = (struct.pack('<BI', block.ident, self._timestamp(tick))[:4] +
+                             block.struct.pack(*values))
+                block.owner.deliver(data)
+
+    def _handle_param(self, pk, link):
+        if pk.channel == toc.TOC_CHANNEL:
+            self._toc(pk, link, self._param_items, self._param_crc)
+            return
+
+        answer = CRTPPacket()
+        answer.set_header(CRTPPort.PARAM, pk.channel)
+
+        if pk.channel == param.READ_CHANNEL:
+            index, = struct.unpack('<H', pk.data[0:2])
+            if index >= len(PARAM_TOC):
+                answer.data = struct.pack('<HB', index, errno.ENOENT)
+            else:
+                answer.data = (struct.pack('<HB', index, 0) +
+                               self._pack_param(index, self._param_values[index]))
+        elif pk.channel == param.WRITE_CHANNEL:
+            index, = struct.unpack('<H', pk.data[0:2])
+            if index >= len(PARAM_TOC) or self._param_items[index][0] & PARAM_RO:
+                return
+            value, = struct.unpack(self._param_types[index], pk.data[2:])
+            self._param_values[index] = value
+            answer.data = struct.pack('<H', index) + self._pack_param(index, value)
+        elif pk.channel == param.MISC_CHANNEL:
+            data = self._param_misc(pk.data)
+            if data is None:
+                return
+            answer.data = data
+        else:
+            return
+
+        link.deliver(answer)
+
+    def _pack_param(self, index, value):
+        pytype = self._param_types[index]
+        if pytype not in ('<f', '<d', '<e'):
+            value = int(value)
+        return struct.pack(pytype, value)
+
+    def _param_misc(self, data):
+        cmd = data[0]
+
+        if cmd == param.MISC_SETBYNAME:
+            group_end = data.index(0, 1)
+            name_end = data.index(0, group_end + 1)
+            group = data[1:group_end].decode('ISO-8859-1')
+            name = data[group_end + 1:name_end].decode('ISO-8859-1')
+            for index, (g, n, _, _, flags) in enumerate(PARAM_TOC):
+                if (g, n) == (group, name) and not flags & PARAM_RO:
+                    pytype = ParamTocElement.types[data[name_end + 1]][1]
+                    value, = struct.unpack(pytype, data[name_end + 2:])
+                    self._param_values[index] = value
+                    return bytes(data[:name_end + 1]) + b'\0'
+            return bytes(data[:name_end + 1]) + bytes((errno.ENOENT,))
+
+        index, = struct.unpack('<H', data[1:3])
+        head = bytes(data[0:3])
+        if index >= len(PARAM_TOC):
+            return head + bytes((errno.ENOENT,))
+
+        persistent = bool(self._param_items[index][0] & PARAM_EXTENDED)
+        default = PARAM_TOC[index][3]
+
+        if cmd == param.MISC_GET_EXTENDED_TYPE_V2:
+            return head + bytes((0, param.ParamTocElement.EXTENDED_PERSISTENT if persistent else 0))
+        if cmd == param.MISC_GET_EXTENDED_TYPE:
+            return head + bytes((param.ParamTocElement.EXTENDED_PERSISTENT if persistent else 0,))
+        if cmd == param.MISC_GET_DEFAULT_VALUE_V2:
+            return head + b'\0' + self._pack_param(index, default)
+        if cmd == param.MISC_GET_DEFAULT_VALUE:
+            return head + self._pack_param(index, default)
+
+        if not persistent:
+            return head + bytes((errno.ENOENT,))
+
+        if cmd == param.MISC_PERSISTENT_STORE:
+            self.eeprom[index] = self._param_values[index]
+            return head + b'\0'
+        if cmd == param.MISC_PERSISTENT_CLEAR:
+            self.eeprom.pop(index, None)
+            return head + b'\0'
+        if cmd == param.MISC_PERSISTENT_GET_STATE:
+            if index in self.eeprom:
+                return (head + b'\1' + self._pack_param(index, default) +
+                        self._pack_param(index, self.eeprom[index]))
+            return head + b'\0' + self._pack_param(index, default)
+
+        return None
+
+
+_devices = {}
+_devices_lock = threading.Lock()
+
+
+def get_device(address: str) -> VirtualCrazyflie:
+    '''
+    Return the virtual Crazyflie answering on address, creating it if this is
+    the first time the address is used. Bootloader addresses (B1...) resolve
+    to the device whose firmware address shares the same lower four bytes.
+    '''
+    address = address.upper()
+    with _devices_lock:
+        if address.startswith('B1'):
+            for dev in _devices.values():
+                if dev.bl_address == address:
+                    return dev
+            address = 'E7' + address[2:]
+
+        if address not in _devices:
+            _devices[address] = VirtualCrazyflie(address)
+        return _devices[address]
+
+
+def find_bootloader(address: str):
+    ''' Return the device using address as bootloader address, or None '''
+    address = address.upper()
+    with _devices_lock:
+        for dev in _devices.values():
+            if dev.bl_address == address:
+                return dev
+    return None
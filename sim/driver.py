@@ -0,0 +1,236 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+A cflib link driver for `sim://` URIs. The URI has the same layout as a
+radio URI, and the link characteristics are given as query parameters:
+
+    sim://0/80/2M/E7E7E7E701?latency_ms=1&jitter_ms=0.5&loss=0.01&bandwidth=1000
+
+    latency_ms  one-way delay of every packet (default 0)
+    jitter_ms   extra uniformly distributed delay, 0..jitter_ms (default 0)
+    loss        probability that a packet is dropped, per direction (default 0)
+    bandwidth   maximum packets per second, per direction (default unlimited)
+    seed        seed for jitter and loss, for repeatable runs
+'''
+import collections
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from cflib.crtp.crtpdriver import CRTPDriver
+from cflib.crtp.exceptions import WrongUriType
+
+from . import device
+
+URI_SCHEME = 'sim://'
+LINK_LOST_TIMEOUT = 1.0  # seconds without acks before reporting link error
+
+
+def parse_uri(uri: str):
+    '''
+    Return (devid, channel, datarate, address, options) for a sim:// or
+    radio:// URI. Extra '?' separators, as added by cflib when it appends
+    options to an URI, are accepted.
+    '''
+    if '?' in uri:
+        base, query = uri.split('?', 1)
+        uri = base + '?' + query.replace('?', '&')
+
+    parsed = urlparse(uri)
+    path = parsed.path.strip('/').split('/')
+
+    devid = int(parsed.netloc) if parsed.netloc.isdigit() else 0
+    channel = int(path[0]) if len(path) > 0 and path[0] else 2
+    datarate = path[1] if len(path) > 1 else '2M'
+    address = '{:0>10}'.format(path[2]).upper() if len(path) > 2 else 'E7E7E7E7E7'
+    options = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+
+    return devid, channel, datarate, address, options
+
+
+class SimDriver(CRTPDriver):
+    ''' Link driver talking to a VirtualCrazyflie instead of a Crazyradio '''
+
+    def __init__(self):
+        super().__init__()
+        self.uri = ''
+        self.address = None
+        self._device = None
+        self._link_error_callback = None
+
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.loss = 0.0
+        self.interval = 0.0
+        self._random = random.Random()
+
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._downlink = []
+        self._sequence = itertools.count()
+        self._last_down = 0.0
+        self._next_up = 0.0
+        self._next_down = 0.0
+        self._lost_since = None
+        self._closed = True
+
+        self._link_statistics_callback = None
+        self._acks = collections.deque(maxlen=100)
+
+    def connect(self, uri, radio_link_statistics_callback, link_error_callback):
+        if uri.startswith(URI_SCHEME):
+            _, _, _, address, options = parse_uri(uri)
+            self._device = device.get_device(address)
+        elif uri.startswith('radio://'):
+            # cflib opens the bootloader with a hard coded radio:// URI, so
+            # claim it if it points to a simulated bootloader.
+            _, _, _, address, options = parse_uri(uri)
+            self._device = device.find_bootloader(address)
+            if self._device is None:
+                raise WrongUriType('Not a simulated bootloader')
+        else:
+            raise WrongUriType('Not a sim URI')
+
+        self.uri = uri
+        self.address = address
+        self._link_error_callback = link_error_callback
+        self._link_statistics_callback = radio_link_statistics_callback
+
+        self.latency = float(options.get('latency_ms', 0)) / 1000.0
+        self.jitter = float(options.get('jitter_ms', 0)) / 1000.0
+        self.loss = float(options.get('loss', 0))
+        bandwidth = float(options.get('bandwidth', 0))
+        self.interval = 1.0 / bandwidth if bandwidth > 0 else 0.0
+        if 'seed' in options:
+            self._random.seed(options['seed'])
+
+        self._closed = False
+
+    def _delay(self):
+        if self.jitter > 0:
+            return self.latency + self._random.uniform(0, self.jitter)
+        return self.latency
+
+    def _lost(self):
+        return self.loss > 0 and self._random.random() < self.loss
+
+    def send_packet(self, pk):
+        if self._closed:
+            return False
+
+        # Like the radio driver, only one packet can be in flight at a time
+        now = time.monotonic()
+        if self.interval:
+            slot = max(now, self._next_up)
+            self._next_up = slot + self.interval
+            if slot > now:
+                time.sleep(slot - now)
+
+        if not self._device.reachable(self.address):
+            if self._lost_since is None:
+                self._lost_since = time.monotonic()
+            self._update_link_quality(False)
+            self._check_link_lost()
+            return True
+        self._lost_since = None
+
+        lost = self._lost()
+        self._update_link_quality(not lost)
+        if not lost:
+            # Answers leave the device once the request has arrived
+            self._local.arrival = time.monotonic() + self._delay()
+            try:
+                self._device.handle(pk, self)
+            finally:
+                self._local.arrival = None
+        return True
+
+    def _update_link_quality(self, acked):
+        # Same as the radio driver, the share of the last 100 packets acked
+        if self._link_statistics_callback is not None:
+            self._acks.append(acked)
+            self._link_statistics_callback({'link_quality': 100.0 * sum(self._acks) / len(self._acks)})
+
+    def deliver(self, pk):
+        ''' Called by the device to queue a packet towards the host '''
+        if self._lost():
+            return
+
+        with self._cond:
+            if self._closed:
+                return
+            sent = getattr(self._local, 'arrival', None) or time.monotonic()
+            due = sent + self._delay()
+            if self.interval:
+                due = max(due, self._next_down)
+                self._next_down = due + self.interval
+            # Packets on a radio link never overtake each other
+            due = max(due, self._last_down)
+            self._last_down = due
+            heapq.heappush(self._downlink, (due, next(self._sequence), pk))
+            self._cond.notify()
+
+    def receive_packet(self, wait=0):
+        deadline = None if wait < 0 else time.monotonic() + wait
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._downlink and self._downlink[0][0] <= now:
+                    return heapq.heappop(self._downlink)[2]
+                if self._closed or (deadline is not None and now >= deadline):
+                    break
+
+                timeout = None if deadline is None else deadline - now
+                if self._downlink:
+                    due = self._downlink[0][0] - now
+                    timeout = due if timeout is None else min(timeout, due)
+                self._cond.wait(timeout)
+
+        self._check_link_lost()
+        return None
+
+    def _check_link_lost(self):
+        if self._lost_since is None or self._link_error_callback is None:
+            return
+        if time.monotonic() - self._lost_since > LINK_LOST_TIMEOUT:
+            callback, self._link_error_callback = self._link_error_callback, None
+            callback('SimDriver: Too many packets lost!')
+
+    def get_status(self):
+        return 'Simulated'
+
+    def get_name(self):
+        return 'sim'
+
+    def scan_interface(self, address=None):
+        return []
+
+    def enum(self):
+        return []
+
+    def get_help(self):
+        return 'sim://<devid>/<channel>/<datarate>/<address>?latency_ms=..&jitter_ms=..&loss=..&bandwidth=..'
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._downlink = []
+            self._cond.notify_all()
+        if self._device is not None:
+            self._device.detach(self)
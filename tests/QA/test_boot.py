@@ -0,0 +1,41 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import pytest
+import conftest
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize('dev', conftest.get_devices(), ids=lambda d: d.name)
+@pytest.mark.usefixtures('raw_link')
+class TestBoot:
+
+    def test_boot_time(self, dev):
+        ''' Reboot the device and time until the firmware answers, and until connected '''
+        requirement = conftest.get_requirement('boot.time')
+
+        results = list()
+        for _ in range(requirement['iterations']):
+            result = dev.reboot(wait=True)
+            assert result, str(result)
+            results.append(result)
+
+        firmware_ms = max(result.firmware for result in results) * 1000
+        connected_ms = max(result.connected for result in results) * 1000
+        logger.info('boot: firmware up in {:.0f} ms, connected in {:.0f} ms (worst of {})'.format(
+            firmware_ms, connected_ms, len(results)))
+
+        assert firmware_ms < requirement['limit_firmware_ms']
+        assert connected_ms < requirement['limit_connected_ms']
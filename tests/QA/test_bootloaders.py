@@ -16,6 +16,7 @@ import conftest
 
 
 @pytest.mark.parametrize('dev', conftest.get_devices(), ids=lambda d: d.name)
+@pytest.mark.usefixtures('raw_link')
 class TestBootloaders:
 
     @staticmethod
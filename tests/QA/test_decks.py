@@ -13,7 +13,6 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import pytest
 import conftest
-import time
 
 
 @pytest.mark.parametrize(
@@ -32,23 +31,10 @@ class TestDecks:
         if not test_setup.device.decks:
             pytest.skip('no decks on device')
 
-        discovered = list()
+        assert test_setup.device.connect_sync(wait_for_params=True)
 
-        def deck_param_callback(name, value):
-            nonlocal discovered
-
-            if int(value) == 1:
-                discovered.append(name.rsplit('.')[-1])  # deck.name => name
-
-        assert test_setup.device.connect_sync()
-
-        test_setup.device.cf.param.add_update_callback(
-            group='deck',
-            name=None,
-            cb=deck_param_callback
-        )
-
-        time.sleep(3)
+        values = test_setup.device.cf.param.values.get('deck', {})
+        discovered = [name for name, value in values.items() if int(value) == 1]
 
         for deck in test_setup.device.decks:
             assert deck in discovered
@@ -13,13 +13,24 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import pytest
 import conftest
+import logging
+import os
 import time
 
-from collections import defaultdict
+import numpy as np
 
 from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.crazyflie.syncLogger import SyncLogger
+from cflib.crtp.crtpstack import CRTPPort
+
+from log_capture import LogCapture
+from log_capture import LogCaptureReader
+from log_replay import LogRecorder
+from log_timing import TS_WRAP
+from log_timing import BlockTiming
+from log_timing import init_log_max_bytes
+
+logger = logging.getLogger(__name__)
 
 
 @pytest.mark.parametrize('test_setup', conftest.get_devices(), indirect=['test_setup'], ids=lambda d: d.name)
@@ -29,23 +40,29 @@ class TestLogVariables:
         ''' Make sure we receive ~100 rows 1 second at 100Hz '''
         requirement = conftest.get_requirement('logging.basic')
         config = init_log_max_bytes()
-        rows = 0
-
-        def log_callback(ts, data, config):
-            nonlocal rows
-            rows += 1
-            assert_variables_included(data, config.variables)
+        rows = conftest.CallbackWaiter()
 
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             scf.cf.log.add_config(config)
-            config.data_received_cb.add_callback(log_callback)
+            config.data_received_cb.add_callback(rows)
 
+            start = time.perf_counter()
             config.start()
-            time.sleep(1)
+            # Returns once the rows of the first second are in, unless they are late
+            rows.wait(requirement['max_rate'] + 3, timeout=2)
             config.stop()
 
-            # With 100 ms frequency we expect 100 rows, allow 3% diff
-            assert abs(requirement['max_rate'] - rows) < 3
+        for ts, data, logconf in rows.calls:
+            assert_variables_included(data, logconf.variables)
+
+        # With 10 ms period we expect 100 rows, allow 3% diff
+        in_one_second = sum(1 for t in rows.times if t - start <= 1.0)
+        assert abs(requirement['max_rate'] - in_one_second) < 3, '{} rows in 1 s'.format(in_one_second)
+
+        # And the firmware timestamps of the rows should span 1000 ms
+        assert rows.count > requirement['max_rate']
+        span = (rows.calls[requirement['max_rate']][0] - rows.calls[0][0]) % TS_WRAP
+        assert abs(span - 1000) < 30
 
     def test_log_too_many_variables(self, test_setup):
         '''
@@ -124,47 +141,95 @@ class TestLogVariables:
         with pytest.raises(AttributeError):
             test_setup.device.cf.log.add_config(config)
 
-    def test_log_stress(self, test_setup):
+    def test_log_stress(self, test_setup, pytestconfig):
         '''
         Make sure we can receive all packets requested when having an effective
-        rate of logging.rate packets/s.
+        rate of logging.rate packets/s. With --record-log the raw log packets
+        are saved for replay with log_replay.py.
         '''
         requirement = conftest.get_requirement('logging.rate')
         if test_setup.kalman_active:
             pytest.skip('Only on non-kalman')
 
+        duration = 10.0
         configs = []
+        timings = dict()
         for i in range(int(requirement['limit_low'] / 100)):
-            configs.append(init_log_max_bytes('MaxGroup_%d' % i))
-
-        packets = defaultdict(lambda: 0)
+            config = init_log_max_bytes('MaxGroup_%d' % i)
+            configs.append(config)
+            timings[config.name] = BlockTiming(config.name, config.period_in_ms, duration)
 
         def stress_cb(ts, data, config):
-            packets[config.name] += 1
+            timings[config.name].record(ts)
 
-        duration = 10.0
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
-            scf.cf.console.receivedChar.add_callback(lambda msg: print(msg))
-            for config in configs:
-                scf.cf.log.add_config(config)
-                config.data_received_cb.add_callback(stress_cb)
-                config.start()
+        record_dir = pytestconfig.getoption('record_log')
+        recorder = LogRecorder(configs)
 
-            time.sleep(duration)
+        with test_setup.connection() as scf:
+            scf.cf.console.receivedChar.add_callback(lambda msg: print(msg))
+            if record_dir:
+                scf.cf.add_port_callback(CRTPPort.LOGGING, recorder)
+            try:
+                for config in configs:
+                    scf.cf.log.add_config(config)
+                    config.data_received_cb.add_callback(stress_cb)
+                    config.start()
+
+                time.sleep(duration)
+
+                for config in configs:
+                    config.stop()
+            finally:
+                if record_dir:
+                    scf.cf.remove_port_callback(CRTPPort.LOGGING, recorder)
+
+        if record_dir:
+            os.makedirs(record_dir, exist_ok=True)
+            recorder.save(os.path.join(record_dir, '{}.json'.format(test_setup.device.name)))
+
+        results = [timing.result() for timing in timings.values()]
+        report = '\n'.join(str(result) for result in results)
+        logger.info('log stress:\n{}'.format(report))
+
+        for result in results:
+            assert result.rows >= duration * 100.0, report  # 100 Hz
+            assert result.jitter_ms <= requirement['limit_jitter_ms'], report
+            assert result.max_gap_ms <= requirement['limit_gap_ms'], report
+
+        rate = sum(result.rows for result in results) / duration
+        assert rate >= requirement['limit_low'], report  # packets / second
+
+    def test_log_capture(self, test_setup, tmp_path):
+        ''' Make sure a second at 100Hz is captured to, and read back from, column files '''
+        requirement = conftest.get_requirement('logging.basic')
+        config = init_log_max_bytes()
+        path = str(tmp_path / config.name)
 
-            for config in configs:
+        with test_setup.connection() as scf:
+            scf.cf.log.add_config(config)
+            # Called after the capture, so the rows are written when it returns
+            rows = conftest.CallbackWaiter()
+            with LogCapture(path, config) as capture:
+                config.data_received_cb.add_callback(capture)
+                config.data_received_cb.add_callback(rows)
+                config.start()
+                received = rows.wait(requirement['max_rate'] + 1, timeout=2)
                 config.stop()
-                assert packets[config.name] >= duration * 100.0  # 100 Hz
 
-            rate = sum(packets.values()) / duration
-            assert rate >= requirement['limit_low']  # packets / second
+        assert received
+        columns = LogCaptureReader(path)
+        ts = columns['ts'].astype(np.int64)
+        assert abs((ts[requirement['max_rate']] - ts[0]) % TS_WRAP - 1000) < 30
+        assert columns.names == ['ts', 'host_ns'] + [v.name for v in config.variables]
+        assert np.all(np.diff(columns['host_ns']) >= 0)
+        assert np.all((np.diff(ts) % TS_WRAP) > 0)
 
     def test_log_sync(self, test_setup):
         ''' Make sure logging synchronous works '''
         requirement = conftest.get_requirement('logging.basic')
         config = init_log_max_bytes()
 
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             with SyncLogger(scf, config) as logger:
                 for rows, (ts, data, config) in enumerate(logger):
                     assert_variables_included(data, config.variables)
@@ -172,21 +237,6 @@ class TestLogVariables:
                         break
 
 
-def init_log_max_bytes(name='MaxGroup'):
-    ''' 7 variables * MAX_GROUPS (16) = 112 which is < MAX_VARIABLES (128) '''
-    config = LogConfig(name=name, period_in_ms=10)
-    config.add_variable('stabilizer.roll', 'float')       # 04 bytes
-    config.add_variable('stabilizer.pitch', 'float')      # 08 bytes
-    config.add_variable('stabilizer.yaw', 'float')        # 12 bytes
-    config.add_variable('stabilizer.thrust', 'uint16_t')  # 14 bytes
-
-    config.add_variable('gyro.xVariance', 'float')        # 18 bytes
-    config.add_variable('gyro.yVariance', 'float')        # 22 bytes
-    config.add_variable('gyro.zVariance', 'float')        # 26 bytes
-
-    return config
-
-
 def assert_variables_included(data, variables):
     assert len(data) == len(variables)
     for v in variables:
@@ -14,10 +14,8 @@
 import pytest
 import conftest
 import logging
-import time
 import random
 
-from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +28,7 @@ logger = logging.getLogger(__name__)
 )
 class TestParameters:
     def test_param_ronly(self, test_setup):
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             # Get a known (core) read-only parameter
             param = 'deck.bcLighthouse4'
             element = scf.cf.param.toc.get_element_by_complete_name(param)
@@ -44,7 +42,7 @@ class TestParameters:
                 scf.cf.param.set_value(param, 1)
 
     def test_param_extended_type(self, test_setup):
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             # Get a known persistent parameter
             param = 'ring.effect'
             element = scf.cf.param.toc.get_element_by_complete_name(param)
@@ -67,118 +65,72 @@ class TestParameters:
         # Get a random valid value
         value = random.randint(8, 13)
 
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        # Not the pooled link, it would still be open on the radio during the reboot
+        with test_setup.connection(fresh=True) as scf:
             # Set Value
             logger.info(f'Setting value {value} as {param}')
             scf.cf.param.set_value(param, value)
 
-            got_callback = False
+            stored = conftest.CallbackWaiter()
+            scf.cf.param.persistent_store(param, stored)
+            assert stored.result(timeout=5) == (param, True)
 
-            def store_cb(name, success):
-                nonlocal got_callback
-                assert name == param
-                assert success
+        booted = test_setup.device.reboot(wait=True)
+        assert booted, str(booted)
 
-                got_callback = True
-
-            scf.cf.param.persistent_store(param, store_cb)
-            tries = 5
-            while not got_callback and tries > 0:
-                time.sleep(1)
-                tries -= 1
-            assert got_callback
-
-            test_setup.device.reboot()
-
-        # Allow time to reboot
-        time.sleep(5)
-
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection(fresh=True) as scf:
             val = scf.cf.param.get_value(param)
             assert int(val) == value
 
     def test_param_persistent_clear(self, test_setup):
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             # Get a known persistent parameter
             param = 'sound.effect'
 
-            gotten_state = False
-
-            def clear_cb(name, success):
-                assert name == param
-                assert success
-
-            def state_cb_1(name, state):
-                nonlocal gotten_state
-
-                assert name == param
-
-                assert state is not None
-                assert isinstance(state.is_stored, bool)
-                assert state.default_value == 0
-                if state.is_stored:
-                    scf.cf.param.persistent_clear(param, clear_cb)
-                    assert state.stored_value is not None
-                else:
-                    assert state.stored_value is None
-
-                gotten_state = True
-
-            scf.cf.param.persistent_get_state(param, state_cb_1)
-            tries = 5
-            while not gotten_state and tries > 0:
-                time.sleep(1)
-                tries -= 1
-            assert gotten_state
-
-            # Allow time to reboot
-            time.sleep(5)
-            gotten_state = False
-
-            def state_cb_2(name, state):
-                nonlocal gotten_state
+            state_cb = conftest.CallbackWaiter()
+            scf.cf.param.persistent_get_state(param, state_cb)
+            name, state = state_cb.result(timeout=5)
 
-                assert name == param
-                assert state is not None
-                assert isinstance(state.is_stored, bool)
-                assert not state.is_stored
-                gotten_state = True
+            assert name == param
+            assert state is not None
+            assert isinstance(state.is_stored, bool)
+            assert state.default_value == 0
+            if state.is_stored:
+                assert state.stored_value is not None
+
+                cleared = conftest.CallbackWaiter()
+                scf.cf.param.persistent_clear(param, cleared)
+                assert cleared.result(timeout=5) == (param, True)
+            else:
+                assert state.stored_value is None
+
+            state_cb = conftest.CallbackWaiter()
+            scf.cf.param.persistent_get_state(param, state_cb)
+            name, state = state_cb.result(timeout=5)
 
-            scf.cf.param.persistent_get_state(param, state_cb_2)
-            tries = 5
-            while not gotten_state and tries > 0:
-                time.sleep(1)
-                tries -= 1
-            assert gotten_state
+            assert name == param
+            assert state is not None
+            assert isinstance(state.is_stored, bool)
+            assert not state.is_stored
 
     def test_param_persistent_get_state(self, test_setup):
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             # Get a known persistent parameter
             param = 'sound.effect'
 
-            gotten_state = False
-
-            def state_cb(name, state):
-                nonlocal gotten_state
-
-                assert name == param
-                assert state is not None
-                logger.info(f'state: {state}')
-                assert isinstance(state.is_stored, bool)
-                assert state.default_value == 0
-                if state.is_stored:
-                    assert state.stored_value is not None
-                else:
-                    assert state.stored_value is None
-
-                gotten_state = True
-
+            state_cb = conftest.CallbackWaiter()
             scf.cf.param.persistent_get_state(param, state_cb)
-            tries = 5
-            while not gotten_state and tries > 0:
-                time.sleep(1)
-                tries -= 1
-            assert gotten_state
+            name, state = state_cb.result(timeout=5)
+
+            assert name == param
+            assert state is not None
+            logger.info(f'state: {state}')
+            assert isinstance(state.is_stored, bool)
+            assert state.default_value == 0
+            if state.is_stored:
+                assert state.stored_value is not None
+            else:
+                assert state.stored_value is None
 
             # Attempt to get state from non-persistent param,
             # make sure we get AttributeError.
@@ -189,49 +141,30 @@ class TestParameters:
     def test_param_set_raw(self, test_setup):
         param = 'ring.effect'
         value = 13  # Gravity effect
-        updated = False
-
-        def param_raw_cb(name: str, val: str):
-            nonlocal param
-            nonlocal value
-            nonlocal updated
 
-            assert name == param
-            assert value == int(val)
-            updated = True
-
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             [group, name] = param.split('.')
 
             scf.wait_for_params()
 
-            # 0x08 = UINT_8,
+            updated = conftest.CallbackWaiter()
             scf.cf.param.add_update_callback(
                 group=group,
                 name=name,
-                cb=param_raw_cb
+                cb=updated
             )
+            # 0x08 = UINT_8,
             scf.cf.param.set_value_raw(param, 0x08, value)
             scf.cf.param.request_param_update(param)
 
-            tries = 5
-            while not updated and tries > 0:
-                time.sleep(1)
-                tries -= 1
-
-            assert updated
+            name, val = updated.result(timeout=5)
+            assert name == param
+            assert int(val) == value
 
     def test_param_set(self, test_setup):
         param = 'stabilizer.estimator'
 
-        def param_cb(name: str, value: str):
-            nonlocal expected
-            nonlocal param
-
-            assert name == param
-            assert expected.pop(0) == int(value)
-
-        with SyncCrazyflie(test_setup.device.link_uri) as scf:
+        with test_setup.connection() as scf:
             [group, name] = param.split('.')
 
             initial = scf.cf.param.get_value(param)
@@ -239,20 +172,15 @@ class TestParameters:
 
             expected = [2, 1, 2, 1, int(initial)]
 
+            updated = conftest.CallbackWaiter()
             scf.cf.param.add_update_callback(
                 group=group,
                 name=name,
-                cb=param_cb
+                cb=updated
             )
 
-            scf.cf.param.set_value(param, 2)
-            scf.cf.param.set_value(param, 1)
-            scf.cf.param.set_value(param, 2)
-            scf.cf.param.set_value(param, 1)
-
-            scf.cf.param.set_value(param, int(initial))
-
-            timeout = 5  # seconds
-            time.sleep(timeout)
+            for value in expected:
+                scf.cf.param.set_value(param, value)
 
-            assert len(expected) == 0
+            assert updated.wait(len(expected), timeout=5)
+            assert [(name, int(value)) for name, value in updated.calls] == [(param, value) for value in expected]
@@ -0,0 +1,344 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Throughput of the parameter subsystem: TOC download, fetching all values and
+writing values, one at a time and in bulk. Values are only ever written
+back unchanged, to writable parameters of the groups in param.bulk.
+
+The persistent parameter store is timed on parameters not stored when the
+test starts, and they are cleared again when it is done, so the parameters
+a device is provisioned with are left alone.
+'''
+import pytest
+import conftest
+import logging
+import threading
+import time
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from cflib.crazyflie import Crazyflie
+from cflib.crazyflie.param import ParamTocElement
+
+from latency import LatencyResult
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.parametrize(
+    'test_setup',
+    conftest.get_devices(),
+    indirect=['test_setup'],
+    ids=lambda d: d.name
+)
+class TestParamThroughput:
+    def test_param_toc_download(self, test_setup):
+        ''' Download the param TOC without and with the TOC cache '''
+        requirement = conftest.get_requirement('param.toc')
+        dev = test_setup.device
+
+        cold = connect_uncached(dev)
+        assert cold, str(cold)
+        # Once to fill the cache, if needed, then once from it
+        assert dev.connect_sync()
+        cached = dev.connect_sync()
+        assert cached, str(cached)
+
+        cold_ms = cold.timings['param_toc'] * 1000
+        cached_ms = cached.timings['param_toc'] * 1000
+        logger.info('param TOC: {:.0f} ms cold, {:.0f} ms cached'.format(cold_ms, cached_ms))
+
+        assert cold_ms < requirement['limit_cold_ms']
+        assert cached_ms < requirement['limit_cached_ms']
+
+    def test_param_fetch_all(self, test_setup):
+        ''' Fetch the values of all parameters, as done on every connect '''
+        requirement = conftest.get_requirement('param.fetch')
+        dev = test_setup.device
+
+        result = dev.connect_sync(wait_for_params=True)
+        assert result, str(result)
+
+        count = sum(len(group) for group in dev.cf.param.toc.toc.values())
+        rate = count / result.timings['param_values']
+        logger.info('param values: {} in {:.0f} ms, {:.0f} params/s'.format(
+            count, result.timings['param_values'] * 1000, rate))
+
+        assert rate > requirement['limit_low']
+
+    def test_param_set_latency(self, test_setup):
+        ''' Round trip of set_value(), until the value is confirmed '''
+        requirement = conftest.get_requirement('param.set')
+
+        with test_setup.connection() as scf:
+            params = writable_params(scf.cf, conftest.get_requirement('param.bulk')['groups'])
+            assert params, 'no writable parameters to write'
+
+            result = set_latency(scf.cf, params[0], requirement['iterations'])
+            logger.info('set_value {}: {}'.format(params[0][0], result))
+
+        assert result.timeouts <= requirement['limit_timeouts']
+        assert result.p50 < requirement['limit_p50_ms']
+        assert result.p99 < requirement['limit_p99_ms']
+
+    def test_param_persistent_latency(self, test_setup):
+        ''' Round trip of persistent_store(), persistent_get_state() and persistent_clear(), per type '''
+        requirement = conftest.get_requirement('param.persistent')
+
+        with test_setup.connection() as scf:
+            params = unstored_params(scf.cf, per_type=requirement['per_type'])
+            if not params:
+                pytest.skip('no persistent parameters that are not stored')
+
+            results = persistent_latency(scf.cf, params, requirement['iterations'])
+
+        report = '\n'.join('{:9} {:8} {}'.format(op, ctype, result) for (op, ctype), result in results.items())
+        logger.info('persistent latency:\n{}'.format(report))
+
+        for result in results.values():
+            assert result.timeouts <= requirement['limit_timeouts'], report
+            assert result.p50 < requirement['limit_p50_ms'], report
+            assert result.p99 < requirement['limit_p99_ms'], report
+
+    def test_param_persistent_growth(self, test_setup):
+        ''' Latency of the persistent store as the number of stored parameters grows '''
+        requirement = conftest.get_requirement('param.persistent')
+
+        with test_setup.connection() as scf:
+            params = unstored_params(scf.cf)[:requirement['max_params']]
+            if len(params) < 2:
+                pytest.skip('less than two persistent parameters that are not stored')
+
+            rows, timeouts = persistent_growth(scf.cf, params)
+
+        report = '\n'.join('{:3} stored: store {:.1f} ms, get_state {:.1f} ms, clear {:.1f} ms'.format(*row)
+                           for row in rows)
+        logger.info('persistent growth, {} timeouts:\n{}'.format(timeouts, report))
+        assert timeouts <= requirement['limit_timeouts'], report
+
+        finite = np.array([row for row in rows if not np.isnan(row).any()])
+        assert len(finite) >= 2, report
+        slope = np.polyfit(finite[:, 0], finite[:, 1], 1)[0]
+        logger.info('store latency grows {:.2f} ms per stored parameter'.format(slope))
+
+        assert slope < requirement['limit_slope_ms'], report
+        assert finite[:, 1:].max() < requirement['limit_p99_ms'], report
+
+    def test_param_bulk_write(self, test_setup):
+        ''' Write many values, waiting for each one (serial) or queueing all of them (pipelined) '''
+        requirement = conftest.get_requirement('param.bulk')
+
+        with test_setup.connection() as scf:
+            params = writable_params(scf.cf, requirement['groups'])
+            assert params, 'no writable parameters to write'
+
+            serial = bulk_write(scf.cf, params, requirement['iterations'], pipelined=False)
+            pipelined = bulk_write(scf.cf, params, requirement['iterations'], pipelined=True)
+
+        logger.info('bulk write of {} values: {:.0f}/s serial, {:.0f}/s pipelined'.format(
+            requirement['iterations'], serial, pipelined))
+
+        assert serial > requirement['limit_low_serial']
+        assert pipelined > requirement['limit_low']
+
+
+def connect_uncached(dev: conftest.BCDevice) -> conftest.ConnectResult:
+    ''' Connect without a TOC cache, so both TOCs are downloaded '''
+    cf = Crazyflie()
+    try:
+        return dev.connect_sync(cf=cf)
+    finally:
+        cf.close_link()
+
+
+def writable_params(cf: Crazyflie, groups: List[str]) -> List[Tuple[str, str]]:
+    ''' (name, current value) of the writable parameters in groups '''
+    params = list()
+    for group in groups:
+        for name, element in cf.param.toc.toc.get(group, {}).items():
+            if element.access != ParamTocElement.RO_ACCESS:
+                complete = '{}.{}'.format(group, name)
+                params.append((complete, cf.param.get_value(complete)))
+    return params
+
+
+class _Confirmations:
+    ''' Counts the confirmed values of parameters, and wakes up waiters '''
+
+    def __init__(self, cf: Crazyflie, names):
+        self._cf = cf
+        self._names = set(names)
+        self._cond = threading.Condition()
+        self.count = 0
+
+    def __enter__(self):
+        self._cf.param.all_update_callback.add_callback(self._updated)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        conftest._remove_callback(self._cf.param.all_update_callback, self._updated)
+
+    def _updated(self, name, value):
+        if name in self._names:
+            with self._cond:
+                self.count += 1
+                self._cond.notify_all()
+
+    def wait(self, count: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.count >= count, timeout)
+
+    def skip(self, count: int):
+        ''' Treat the first count confirmations as made, whether they came or not '''
+        with self._cond:
+            self.count = count
+
+
+def set_latency(cf: Crazyflie, param: Tuple[str, str], count: int, timeout=2) -> LatencyResult:
+    ''' Write a value count times, one at a time, and time until each is confirmed '''
+    name, value = param
+    samples = np.full(count, np.nan)
+
+    with _Confirmations(cf, [name]) as confirmations:
+        for i in range(count):
+            start = time.perf_counter_ns()
+            cf.param.set_value(name, value)
+            if confirmations.wait(i + 1, timeout):
+                samples[i] = (time.perf_counter_ns() - start) / 1e6
+            else:
+                # Do not mistake the late confirmation for the next one
+                confirmations.skip(i + 1)
+
+    return LatencyResult(samples)
+
+
+def bulk_write(cf: Crazyflie, params: List[Tuple[str, str]], count: int, pipelined: bool, timeout=10) -> float:
+    '''
+    Write count values, cycling over params, and return the writes per
+    second. Serial waits for each value to be confirmed before the next,
+    pipelined queues all of them in cflib and waits for the confirmations.
+    '''
+    writes = [params[i % len(params)] for i in range(count)]
+
+    with _Confirmations(cf, [name for name, _ in params]) as confirmations:
+        start = time.perf_counter()
+        for i, (name, value) in enumerate(writes):
+            cf.param.set_value(name, value)
+            if not pipelined:
+                assert confirmations.wait(i + 1, timeout), 'write of {} not confirmed'.format(name)
+
+        assert confirmations.wait(count, timeout), '{} of {} writes confirmed'.format(confirmations.count, count)
+        return count / (time.perf_counter() - start)
+
+
+def persistent_call(cf: Crazyflie, op: str, name: str, timeout=2) -> float:
+    '''
+    Call persistent_<op>() (store, get_state or clear) for name and return the
+    ms until its callback, or nan if it did not call back within timeout.
+    '''
+    done = conftest.CallbackWaiter()
+    start = time.perf_counter_ns()
+    getattr(cf.param, 'persistent_' + op)(name, done)
+    if not done.wait(1, timeout):
+        return float('nan')
+    elapsed = (time.perf_counter_ns() - start) / 1e6
+
+    # store and clear call back with success, get_state with the state
+    _, status = done.calls[0]
+    assert status, 'persistent_{}({}) failed'.format(op, name)
+    return elapsed
+
+
+def unstored_params(cf: Crazyflie, per_type: Optional[int] = None) -> List[str]:
+    ''' The writable persistent parameters not stored, at most per_type of each type if given '''
+    by_type = dict()  # type: Dict[str, List[str]]
+    for group, elements in cf.param.toc.toc.items():
+        for name, element in elements.items():
+            if element.access == ParamTocElement.RO_ACCESS or not element.is_persistent():
+                continue
+            params = by_type.setdefault(element.ctype, [])
+            if per_type is not None and len(params) >= per_type:
+                continue
+
+            complete = '{}.{}'.format(group, name)
+            state = conftest.CallbackWaiter()
+            cf.param.persistent_get_state(complete, state)
+            _, value = state.result(timeout=2)
+            if value is not None and not value.is_stored:
+                params.append(complete)
+
+    return [param for params in by_type.values() for param in params]
+
+
+def persistent_latency(cf: Crazyflie, params: List[str], count: int) -> Dict[Tuple[str, str], LatencyResult]:
+    '''
+    Store, get the state of and clear each parameter count times, and return
+    the latencies by operation and parameter type. The parameters are not
+    stored when it returns. A timeout ends the measurement, since cflib would
+    take the late answer for the answer to the next call.
+    '''
+    ops = ('store', 'get_state', 'clear')
+    ctypes = {param: cf.param.toc.get_element_by_complete_name(param).ctype for param in params}
+    samples = {(op, ctype): list() for op in ops for ctype in ctypes.values()}
+
+    try:
+        for _ in range(count):
+            for param in params:
+                for op in ops:
+                    ms = persistent_call(cf, op, param)
+                    samples[(op, ctypes[param])].append(ms)
+                    if np.isnan(ms):
+                        return {key: LatencyResult(np.array(s)) for key, s in samples.items()}
+    finally:
+        for param in params:
+            persistent_call(cf, 'clear', param)
+
+    return {key: LatencyResult(np.array(s)) for key, s in samples.items()}
+
+
+def persistent_growth(cf: Crazyflie, params: List[str]) -> Tuple[List[Tuple[int, float, float, float]], int]:
+    '''
+    Store the parameters one at a time, then clear them in reverse order, and
+    return (parameters stored before, store ms, get_state ms, clear ms) for
+    each step, and the number of timeouts. The state is fetched right after
+    storing, and clearing the parameter takes it back to the same number of
+    stored parameters. A timeout ends the measurement, as in
+    persistent_latency(), and the steps not measured are nan.
+    '''
+    steps = [[stored, float('nan'), float('nan'), float('nan')] for stored in range(len(params))]
+    calls = ([(stored, 1, 'store') for stored in range(len(params))] +
+             [(stored, 3, 'clear') for stored in reversed(range(len(params)))])
+    timeouts = 0
+    try:
+        for stored, column, op in calls:
+            steps[stored][column] = persistent_call(cf, op, params[stored])
+            if np.isnan(steps[stored][column]):
+                timeouts += 1
+                break
+            if op == 'store':
+                steps[stored][2] = persistent_call(cf, 'get_state', params[stored])
+                if np.isnan(steps[stored][2]):
+                    timeouts += 1
+                    break
+    finally:
+        for stored, _, _, clear_ms in steps:
+            if np.isnan(clear_ms):
+                persistent_call(cf, 'clear', params[stored])
+
+    return [tuple(step) for step in steps], timeouts
@@ -12,121 +12,142 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import pytest
-import time
-import struct
+import threading
 
-import numpy as np
-
-import cflib.crtp
-from cflib.crtp.crtpstack import CRTPPacket
-from cflib.crtp.crtpstack import CRTPPort
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import Optional
 
 import conftest
 import logging
 
+from echo import BandwidthResult
+from echo import SequenceChecker
+from echo import bandwidth
+from echo import bandwidth_sweep
+from echo import latency
+from latency import LatencyResult
+
 logger = logging.getLogger(__name__)
 
 
 @pytest.mark.parametrize('dev', conftest.get_devices(), ids=lambda d: d.name)
+@pytest.mark.usefixtures('raw_link')
 class TestRadio:
     def test_latency_small_packets(self, dev):
         requirement = conftest.get_requirement('radio.latencysmall')
-        assert(latency(dev.link_uri, requirement['packet_size']) < requirement['limit_high_ms'])
+        assert_latency(latency(dev.link_uri, requirement['packet_size']), requirement)
 
     def test_latency_big_packets(self, dev):
         requirement = conftest.get_requirement('radio.latencybig')
-        assert(latency(dev.link_uri, requirement['packet_size']) < requirement['limit_high_ms'])
+        assert_latency(latency(dev.link_uri, requirement['packet_size']), requirement)
 
     def test_bandwidth_small_packets(self, dev):
         requirement = conftest.get_requirement('radio.bwsmall')
-        assert(bandwidth(dev.link_uri, requirement['packet_size']) > requirement['limit_low'])
+        result = bandwidth(dev.link_uri, requirement['packet_size'], window=requirement.get('window'))
+        assert(result.rate > requirement['limit_low'])
 
     def test_bandwidth_big_packets(self, dev):
         requirement = conftest.get_requirement('radio.bwbig')
-        assert(bandwidth(dev.link_uri, requirement['packet_size']) > requirement['limit_low'])
+        result = bandwidth(dev.link_uri, requirement['packet_size'], window=requirement.get('window'))
+        assert(result.rate > requirement['limit_low'])
+
+    def test_bandwidth_window_sweep(self, dev):
+        '''
+        Measure the throughput for a growing number of packets in flight, to
+        find where the link saturates. The best rate must meet radio.bwsmall.
+        '''
+        requirement = conftest.get_requirement('radio.bwsmall')
+        results = bandwidth_sweep(dev.link_uri, requirement['packet_size'])
+        for result in results:
+            logger.info('window {:3}: {}'.format(result.window, result))
+
+        assert(max(result.rate for result in results) > requirement['limit_low'])
 
     def test_reliability(self, dev):
         requirement = conftest.get_requirement('radio.reliability')
-        # The bandwidth function will assert if there is any packet loss
-        bandwidth(dev.link_uri, 4, requirement['limit_low'])
-
-
-def build_data(i, packet_size):
-    assert(packet_size % 4 == 0)
-    repeats = packet_size // 4
-    return struct.pack('<' + 'I'*repeats, *[i]*repeats)
-
-
-def latency(uri, packet_size=4, count=500):
-    link = cflib.crtp.get_link_driver(uri)
-
-    try:
-        pk = CRTPPacket()
-        pk.set_header(CRTPPort.LINKCTRL, 0)  # Echo channel
-
-        latencies = []
-        for i in range(count):
-            pk.data = build_data(i, packet_size)
-
-            start_time = time.time()
-            if not link.send_packet(pk):
-                link.close()
-                raise Exception("send_packet() timeout!")
-            while True:
-                pk_ack = link.receive_packet(2)
-                if pk_ack is None:
-                    link.close()
-                    raise Exception("Receive packet timeout!")
-                if pk_ack.port == CRTPPort.LINKCTRL and pk_ack.channel == 0:
-                    break
-            end_time = time.time()
-
-            # make sure we actually received the expected value
-            i_recv, = struct.unpack('<I', pk_ack.data[0:4])
-            assert(i == i_recv)
-            latencies.append((end_time - start_time) * 1000)
-    except Exception as e:
-        link.close()
-        raise e
-
-    link.close()
-    result = np.min(latencies)
-    logger.info('latency: {}'.format(result))
+        checker = SequenceChecker()
+        bandwidth(dev.link_uri, 4, requirement['limit_low'], checker=checker)
+
+        logger.info('reliability: {}'.format(checker))
+        assert checker.received + checker.lost == requirement['limit_low'], str(checker)
+        assert checker.loss_ratio <= requirement['limit_loss_ratio'], str(checker)
+        assert checker.duplicates <= requirement['limit_duplicates'], str(checker)
+        assert checker.reordered <= requirement['limit_reordered'], str(checker)
+
+
+@pytest.mark.parametrize('devices', list(conftest.get_devices_by_radio().values()), ids=lambda g: g[0].radio)
+class TestRadioAggregate:
+    '''
+    Drive echo links to 1..N devices on the same Crazyradio at the same time.
+    The aggregate throughput must meet the requirement for every K.
+    '''
+
+    def test_aggregate_small_packets(self, devices, connection_pool):
+        assert_aggregate(devices, conftest.get_requirement('radio.aggregatesmall'), connection_pool)
+
+    def test_aggregate_big_packets(self, devices, connection_pool):
+        assert_aggregate(devices, conftest.get_requirement('radio.aggregatebig'), connection_pool)
+
+
+def assert_latency(result: LatencyResult, requirement):
+    assert result.timeouts <= requirement['limit_timeouts']
+    assert result.min < requirement['limit_high_ms']
+    assert result.p99 < requirement['limit_p99_ms']
+
+
+class AggregateResult:
+    '''
+    Throughput and latency of links driven at the same time, by aggregate().
+    The aggregate rate is all answers over the time of the slowest link.
+    '''
+
+    def __init__(self, names: List[str], links: List[BandwidthResult], latencies: List[LatencyResult]):
+        self.names = names
+        self.links = links
+        self.latencies = latencies
+        self.duration = max(r.duration for r in links)
+        self.rate = sum(r.count for r in links) / self.duration
+
+    def __str__(self):
+        lines = ['{} links: {:.0f} packets/s aggregate'.format(len(self.links), self.rate)]
+        for name, link, lat in zip(self.names, self.links, self.latencies):
+            lines.append('  {}: {:.0f} packets/s, latency p50 {:.2f} ms, p99 {:.2f} ms, {} timeouts'.format(
+                name, link.rate, lat.p50, lat.p99, lat.timeouts))
+        return '\n'.join(lines)
+
+
+def aggregate(uris: List[str], packet_size=4, count=500, window=None, latency_count=200,
+              names: Optional[List[str]] = None) -> AggregateResult:
+    '''
+    Measure the throughput of echo links to all uris at the same time, then
+    their latency at the same time. Devices sharing a Crazyradio split its
+    capacity between them.
+    '''
+    barrier = threading.Barrier(len(uris))
+    with ThreadPoolExecutor(max_workers=len(uris)) as executor:
+        links = list(executor.map(
+            lambda uri: bandwidth(uri, packet_size, count, window, barrier=barrier), uris))
+        latencies = list(executor.map(lambda uri: latency(uri, packet_size, latency_count), uris))
+
+    result = AggregateResult(names or uris, links, latencies)
+    logger.info('aggregate: {}'.format(result))
 
     return result
 
 
-def bandwidth(uri, packet_size=4, count=500):
-    link = cflib.crtp.get_link_driver(uri)
-
-    try:
-        # enqueue packets
-        start_time = time.time()
-        for i in range(count):
-            pk = CRTPPacket()
-            pk.set_header(CRTPPort.LINKCTRL, 0)  # Echo channel
-            pk.data = build_data(i, packet_size)
-            if not link.send_packet(pk):
-                raise Exception("send_packet() timeout!")
-
-        # get the result
-        for i in range(count):
-            while True:
-                pk_ack = link.receive_packet(2)
-                if pk_ack is None:
-                    raise Exception("Receive packet timeout!")
-                if pk_ack.port == CRTPPort.LINKCTRL and pk_ack.channel == 0:
-                    break
-            # make sure we actually received the expected value
-            i_recv, = struct.unpack('<I', pk_ack.data[0:4])
-            assert(i_recv == i)
-        end_time = time.time()
-    except Exception as e:
-        link.close()
-        raise e
-
-    link.close()
-    result = count / (end_time - start_time)
-    logger.info('bandwidth: {}'.format(result))
+def aggregate_sweep(devices: List[conftest.BCDevice], packet_size=4, count=500, window=None) -> List[AggregateResult]:
+    ''' Measure the aggregate throughput of the first K devices, for K = 1..N '''
+    return [aggregate([dev.link_uri for dev in devices[:k]], packet_size, count, window,
+                      names=[dev.name for dev in devices[:k]])
+            for k in range(1, len(devices) + 1)]
 
-    return result
+
+def assert_aggregate(devices, requirement, connection_pool):
+    # The links need the radio to themselves
+    connection_pool.close(devices[0].radio)
+
+    results = aggregate_sweep(devices, requirement['packet_size'], window=requirement.get('window'))
+    report = '\n'.join(str(result) for result in results)
+    for result in results:
+        assert result.rate > requirement['limit_low'], report
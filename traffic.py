@@ -0,0 +1,159 @@
+# Copyright (C) 2021 Bitcraze AB
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, in version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+'''
+Traffic generator for the radio tests. Packets carry a little endian uint32
+sequence number first in the payload, and are written in place into a small
+ring of reused CRTPPackets, so generating a packet does not build format
+strings, lists or packet objects.
+
+Run it as a script to see how many packets/s the generator itself sustains,
+without any link, compared to building each packet from scratch.
+'''
+import random
+import struct
+import time
+
+from cflib.crtp.crtpstack import CRTPPacket
+from cflib.crtp.crtpstack import CRTPPort
+
+SEQUENCE = struct.Struct('<I')
+
+PATTERNS = ('sequence', 'random')
+
+# The radio driver copies a packet when it takes it from its single slot
+# queue, so a packet can be reused once two more have been sent after it.
+DEPTH = 4
+
+# Random payloads are windows into this many random bytes
+RANDOM_POOL = 4096
+
+
+def sequence(data) -> int:
+    ''' The sequence number of a generated packet, or of its echo '''
+    return SEQUENCE.unpack_from(data)[0]
+
+
+class TrafficGenerator:
+    '''
+    Generates packets of packet_size bytes (a multiple of 4) to a port and
+    channel, the echo channel by default. The payload after the sequence
+    number is set by pattern:
+
+        sequence  the sequence number repeated in every 4 byte word
+        random    random bytes, different for every packet (repeatable by seed)
+        bytes     the given bytes, repeated
+
+    A packet returned by packet() is only valid until depth more packets
+    have been generated.
+    '''
+
+    def __init__(self, packet_size=4, pattern='sequence', port=CRTPPort.LINKCTRL, channel=0,
+                 depth=DEPTH, seed=None):
+        if packet_size % 4 != 0 or not 4 <= packet_size <= CRTPPacket.MAX_DATA_SIZE:
+            raise ValueError('packet_size must be a multiple of 4, up to {}, not {}'.format(
+                CRTPPacket.MAX_DATA_SIZE, packet_size))
+        if not isinstance(pattern, (bytes, bytearray)) and pattern not in PATTERNS:
+            raise ValueError('pattern must be bytes or one of {}, not {!r}'.format(PATTERNS, pattern))
+
+        self.packet_size = packet_size
+        self.pattern = pattern
+        self._offsets = range(0, packet_size, 4) if pattern == 'sequence' else (0,)
+
+        self._pool = None
+        if pattern == 'random':
+            rng = random.Random(seed)
+            self._pool = memoryview(bytes(rng.getrandbits(8) for _ in range(RANDOM_POOL)))
+
+        fill = bytes(packet_size)
+        if isinstance(pattern, (bytes, bytearray)) and pattern:
+            fill = (bytes(4) + bytes(pattern) * packet_size)[:packet_size]
+
+        self._packets = list()
+        self._buffers = list()
+        for _ in range(depth):
+            pk = CRTPPacket()
+            pk.set_header(port, channel)
+            pk.data = bytearray(fill)
+            self._packets.append(pk)
+            self._buffers.append(memoryview(pk.data))
+
+    def packet(self, seq: int) -> CRTPPacket:
+        ''' The packet with sequence number seq, written into a reused packet '''
+        slot = seq % len(self._packets)
+        buffer = self._buffers[slot]
+        for offset in self._offsets:
+            SEQUENCE.pack_into(buffer, offset, seq)
+        if self._pool is not None:
+            start = (seq * 31) % (RANDOM_POOL - self.packet_size)
+            buffer[4:] = self._pool[start:start + self.packet_size - 4]
+        return self._packets[slot]
+
+    def stream(self, count: int, rate=None, start=0):
+        '''
+        Yield (seq, packet) for count packets, at most rate packets/s if
+        given. The schedule is absolute, so a late packet is followed by the
+        next ones at once until the generator is back on time.
+        '''
+        if not rate:
+            for seq in range(start, start + count):
+                yield seq, self.packet(seq)
+            return
+
+        period = 1_000_000_000 / rate
+        begin = time.perf_counter_ns()
+        for n in range(count):
+            wait = begin + n * period - time.perf_counter_ns()
+            if wait > 0:
+                time.sleep(wait / 1e9)
+            seq = start + n
+            yield seq, self.packet(seq)
+
+
+def _build_packet(seq, packet_size):
+    ''' A packet built the way the radio tests used to, for comparison '''
+    repeats = packet_size // 4
+    pk = CRTPPacket()
+    pk.set_header(CRTPPort.LINKCTRL, 0)
+    pk.data = struct.pack('<' + 'I' * repeats, *[seq] * repeats)
+    return pk
+
+
+def _rate(fn, count) -> float:
+    start = time.perf_counter_ns()
+    for seq in range(count):
+        fn(seq)
+    return count / ((time.perf_counter_ns() - start) / 1e9)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure the packets/s the traffic generator sustains, host only')
+    parser.add_argument('--count', type=int, default=200_000, help='Packets per measurement')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[4, 16, 28])
+    parser.add_argument('--rate', type=float, default=1000, help='Target rate for the paced measurement')
+    p = parser.parse_args()
+
+    print('{:>5} {:>14} {:>14} {:>14} {:>14}'.format('size', 'rebuilt', 'sequence', 'random', 'bytes'))
+    for size in p.sizes:
+        rates = [_rate(lambda seq: _build_packet(seq, size), p.count)]
+        for pattern in ('sequence', 'random', b'\xa5'):
+            rates.append(_rate(TrafficGenerator(size, pattern).packet, p.count))
+        print('{:>5} {}'.format(size, ' '.join('{:>10.0f} p/s'.format(r) for r in rates)))
+
+    count = int(p.rate)
+    start = time.perf_counter()
+    for _ in TrafficGenerator().stream(count, p.rate):
+        pass
+    print('paced at {:.0f} p/s: {:.0f} p/s'.format(p.rate, count / (time.perf_counter() - start)))
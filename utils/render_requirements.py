@@ -12,17 +12,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
-import glob
 import os
-import toml
 import traceback
 import sys
 
 from mdutils.mdutils import MdUtils
 from pathlib import Path
 
-DIR = os.path.dirname(os.path.realpath(__file__))
-REQUIREMENT = os.path.join(DIR, '../requirements/')
+#
+# This is to make it possible to import from requirements_index
+#
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.join(currentdir, '..')
+sys.path.append(parentdir)
+
+from requirements_index import REQUIREMENT, RequirementIndex  # noqa
 
 
 def render_md(name: str, data: dict, md: MdUtils, level: int) -> bool:
@@ -75,16 +79,30 @@ def render_requirement(name: str, requirement: dict) -> bool:
     return result
 
 
+def file_requirements(index: RequirementIndex, file: str) -> dict:
+    ''' The requirements of a TOML file, as nested dicts like in the file '''
+    groups = dict()
+    for group in index.groups_in(file):
+        groups[group.name] = dict(group.fields)
+        for req in group.requirements:
+            groups[group.name][req.name] = dict(req.fields)
+
+    return {'requirement': groups}
+
+
 def render():
-    requirements = glob.glob(REQUIREMENT + '*.toml')
+    try:
+        index = RequirementIndex.load()
+    except Exception as err:
+        print(f'Failed to load requirements: {err}', file=sys.stderr)
+        traceback.print_exc()
+        sys.exit(1)
+
+    requirements = [os.path.join(REQUIREMENT, file) for file in index.files()]
     for requirement in requirements:
-        try:
-            req = toml.load(open(requirement))
-            if not render_requirement(requirement, req):
-                print(f'Failed to render {requirement}', file=sys.stderr)
-        except Exception as err:
-            print(f'Failed to load requirement TOML file: {err}')
-            traceback.print_exc()
+        req = file_requirements(index, Path(requirement).name)
+        if not render_requirement(requirement, req):
+            print(f'Failed to render {requirement}', file=sys.stderr)
 
     readme = MdUtils(
         file_name=os.path.join(REQUIREMENT, 'README.md'),